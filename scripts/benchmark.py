@@ -0,0 +1,311 @@
+'''Benchmarks of the build steps.
+
+Each step is timed on `FiraMath.glyphspackage`, and on synthetic packages with every glyph copied
+2 or 4 times (`--scales 1,2,4`), to see how the build scales with the glyph count. The results
+are written as JSON, and can be compared with a previous run to catch regressions, e.g. after
+upgrading glyphsLib or fontmake:
+
+    python scripts/benchmark.py --output build/benchmark-baseline.json
+    pip install -U fontmake
+    python scripts/benchmark.py --compare build/benchmark-baseline.json
+
+The baseline depends on the machine, so it is not stored in the repository.
+'''
+
+import argparse
+import copy
+import gc
+import json
+import os
+import pickle
+import platform
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import fontmake
+import fontTools
+import glyphsLib
+
+import glyphs_package
+from bounds import BoundsCache
+from build import Font, _build_otf, eprint
+
+BENCHMARKS = (
+    'font_init',
+    'decompose_smart_comp',
+    'to_ufos',
+    'build_otf',
+    'parse_math_table',
+    'math_table_encode',
+)
+
+# A benchmark is slower if its median is more than this ratio above the baseline.
+DEFAULT_THRESHOLD = 0.1
+
+_UNICODE_RE = re.compile(r'^unicode = (\([^)]*\)|[^;\n]*);\n', re.MULTILINE)
+
+
+class _Context:
+    '''The inputs of the benchmarks at one scale, created on first use and shared by the
+    benchmarks.
+    '''
+
+    def __init__(self, path: str, toml_path: str, style: str, tmp_dir: str):
+        self.path = path
+        self.toml_path = toml_path
+        self.style = style
+        self.tmp_dir = tmp_dir
+        self._font = None
+        self._raw_font = None
+        self._ufo = None
+        self._math_table = None
+
+    @property
+    def font(self) -> Font:
+        '''The preprocessed font. It is not modified by the benchmarks.'''
+        if self._font is None:
+            self._font = Font(self.path)
+        return self._font
+
+    @property
+    def raw_font(self) -> bytes:
+        '''The pickled `GSFont`, before decomposing smart components.'''
+        if self._raw_font is None:
+            self._raw_font = pickle.dumps(glyphs_package.load(self.path), pickle.HIGHEST_PROTOCOL)
+        return self._raw_font
+
+    @property
+    def ufo(self):
+        if self._ufo is None:
+            self._ufo = self.font.to_ufos(styles=[self.style])[0]
+        return self._ufo
+
+    @property
+    def math_table(self):
+        if self._math_table is None:
+            self._math_table = self.font._parse_math_table(self.toml_path, [self.style])[self.style]
+        return self._math_table
+
+
+def _bench_font_init(ctx: _Context):
+    return None, lambda _: Font(ctx.path)
+
+
+def _bench_decompose_smart_comp(ctx: _Context):
+    font = ctx.font
+
+    def setup():
+        # A copy of `ctx.font` before decomposition
+        result = copy.copy(font)
+        result.font = pickle.loads(ctx.raw_font)
+        result._build_indexes()
+        return result
+
+    return setup, lambda f: f._decompose_smart_comp()
+
+
+def _bench_to_ufos(ctx: _Context):
+    return None, lambda _: ctx.font.to_ufos(styles=[ctx.style])
+
+
+def _bench_build_otf(ctx: _Context):
+    ufo = ctx.ufo
+    output_dir = os.path.join(ctx.tmp_dir, 'otf')
+    # The UFO is modified in place by the compilation.
+    return lambda: copy.deepcopy(ufo), lambda u: _build_otf(u, output_dir)
+
+
+def _bench_parse_math_table(ctx: _Context):
+    font = ctx.font
+
+    def setup():
+        # Start from an empty bounds cache, as in a build
+        result = copy.copy(font)
+        result.bounds = BoundsCache(result.font)
+        return result
+
+    return setup, lambda f: f._parse_math_table(ctx.toml_path)
+
+
+def _bench_math_table_encode(ctx: _Context):
+    math_table = ctx.math_table
+    return None, lambda _: math_table.encode()
+
+
+def _measure(setup, run, repeat: int, warmup: int) -> list[float]:
+    '''Return the wall times of `repeat` calls of `run(setup())`, after `warmup` calls. `setup()`
+    is not timed.
+    '''
+    times = []
+    for i in range(warmup + repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        start_time = time.perf_counter()
+        run(arg)
+        t = time.perf_counter() - start_time
+        if i >= warmup:
+            times.append(t)
+    return times
+
+
+def _stats(times: list[float]) -> dict[str]:
+    q1, _, q3 = statistics.quantiles(times, n=4) if len(times) > 1 else (times[0],) * 3
+    return {
+        'runs': len(times),
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0,
+        'iqr': q3 - q1,
+        'times': times,
+    }
+
+
+def scaled_package(path: str, scale: int, output_dir: str) -> str:
+    '''Write a copy of the `.glyphspackage` `path` with `scale` times as many glyphs to
+    `output_dir`, and return its path. The extra glyphs are copies of every glyph, named with a
+    `.copyN` suffix and without Unicode values; their components still reference the original
+    glyphs.
+    '''
+    output_path = os.path.join(output_dir, f'{scale}x', os.path.basename(path))
+    if os.path.isdir(output_path):
+        return output_path
+    shutil.copytree(path, output_path)
+    glyphs_dir = os.path.join(output_path, 'glyphs')
+    for file_name in sorted(os.listdir(glyphs_dir)):
+        if not file_name.endswith('.glyph'):
+            continue
+        with open(os.path.join(glyphs_dir, file_name), encoding='utf-8') as f:
+            text = _UNICODE_RE.sub('', f.read())
+        stem = os.path.splitext(file_name)[0]
+        for i in range(1, scale):
+            new_text = glyphs_package.GLYPH_NAME_RE.sub(
+                lambda m, i=i: f'glyphname = "{m.group(1)}.copy{i}";', text, count=1
+            )
+            new_path = os.path.join(glyphs_dir, f'{stem}.copy{i}.glyph')
+            with open(new_path, 'w', encoding='utf-8') as f:
+                f.write(new_text)
+    return output_path
+
+
+def run_benchmarks(
+    path: str,
+    toml_path: str,
+    names: list[str] = BENCHMARKS,
+    scales: list[int] = (1,),
+    style: str = 'Regular',
+    repeat: int = 5,
+    warmup: int = 1,
+) -> dict[str]:
+    '''Run the benchmarks `names` at each of `scales`, and return the results as a dict. A
+    benchmark that raises an exception is reported with its error, and doesn't stop the others.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in scales:
+            scaled_path = path if scale == 1 else scaled_package(path, scale, tmp_dir)
+            ctx = _Context(scaled_path, toml_path, style, tmp_dir)
+            for name in names:
+                key = f'{name}@{scale}x'
+                eprint(f'{key}...', end=' ')
+                try:
+                    setup, run = globals()[f'_bench_{name}'](ctx)
+                    times = _measure(setup, run, repeat, warmup)
+                except Exception as e:  # pylint: disable=broad-except
+                    results[key] = {'error': f'{type(e).__name__}: {e}'}
+                    eprint(f'failed: {results[key]["error"]}')
+                    continue
+                results[key] = _stats(times)
+                eprint(f'median {results[key]["median"]:.3f}s, stdev {results[key]["stdev"]:.3f}s')
+    return {
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'fontmake': fontmake.__version__,
+            'fontTools': fontTools.__version__,
+            'glyphsLib': glyphsLib.__version__,
+        },
+        'results': results,
+    }
+
+
+def compare(results: dict[str], baseline: dict[str], threshold: float = DEFAULT_THRESHOLD):
+    '''Print the ratio of each median to the baseline, and return the benchmarks slower than the
+    baseline by more than `threshold`.
+    '''
+    slower = []
+    for key, value in results['results'].items():
+        old_value = baseline['results'].get(key, {})
+        if 'median' not in value or 'median' not in old_value:
+            continue
+        ratio = value['median'] / old_value['median']
+        # Differences within the noise of both runs are not regressions.
+        noise = value['iqr'] + old_value['iqr']
+        is_slower = ratio > 1 + threshold and value['median'] - old_value['median'] > noise
+        if is_slower:
+            slower.append(key)
+        eprint(
+            f'{key:32} {old_value["median"]:8.3f}s -> {value["median"]:8.3f}s '
+            f'({ratio - 1:+.1%}){"  SLOWER" if is_slower else ""}'
+        )
+    for name in ('python', 'fontmake', 'fontTools', 'glyphsLib'):
+        if results['environment'][name] != baseline['environment'].get(name):
+            eprint(f'{name}: {baseline["environment"].get(name)} -> {results["environment"][name]}')
+    return slower
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description='Benchmark the build steps of Fira Math.')
+    parser.add_argument('--input', default='src/FiraMath.glyphspackage', help='Glyphs source')
+    parser.add_argument('--toml', default='src/FiraMath.toml', help='MATH table data')
+    parser.add_argument(
+        '--benchmarks',
+        type=lambda s: s.split(','),
+        default=list(BENCHMARKS),
+        help=f'comma-separated benchmarks to run (default: {",".join(BENCHMARKS)})',
+    )
+    parser.add_argument(
+        '--scales',
+        type=lambda s: [int(i) for i in s.split(',')],
+        default=[1],
+        help='comma-separated glyph count multipliers, e.g. "1,2,4" (default: 1)',
+    )
+    parser.add_argument('--style', default='Regular', help='style of the UFO and OTF benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each benchmark')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs before timing')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help='slowdown ratio reported as a regression (default: %(default)s)',
+    )
+    args = parser.parse_args(argv)
+    if unknown := [b for b in args.benchmarks if b not in BENCHMARKS]:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)}')
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    results = run_benchmarks(
+        args.input, args.toml, args.benchmarks, args.scales, args.style, args.repeat, args.warmup
+    )
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if slower := compare(results, baseline, args.threshold):
+            eprint(f'Slower than the baseline: {", ".join(slower)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+'''Bounding boxes of glyph layers.
+
+`GSLayer.bounds` rebuilds the segment objects of every path each time it is called. The
+`BoundsCache` here computes the same bounds (bit for bit) with NumPy, for many layers at once, and
+keeps them for the next lookups.
+'''
+
+import numpy as np
+from glyphsLib import GSFont, GSLayer
+from glyphsLib.classes import CURVE, LINE, OFFCURVE
+
+# (left, bottom, width, height), the same as `glyphsLib.types.Rect`
+Bounds = tuple[float, float, float, float]
+
+
+class BoundsCache:
+
+    def __init__(self, font: GSFont):
+        self.font = font
+        # (glyph name, layer ID) -> bounds, or `None` for empty layers
+        self._bounds: dict[tuple[str, str], Bounds] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bounds(self, glyph_name: str, layer_id: str) -> Bounds:
+        '''Return the bounds of a layer, the same as `GSLayer.bounds` but as a tuple.'''
+        key = (glyph_name, layer_id)
+        if key in self._bounds:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.prefetch([key])
+        return self._bounds[key]
+
+    def prefetch(self, keys: list[tuple[str, str]]):
+        '''Compute the bounds of all the `(glyph name, layer ID)` in `keys` in a batch.'''
+        keys = [k for k in dict.fromkeys(keys) if k not in self._bounds]
+        # Layers referenced by components first
+        referenced = [
+            (c.name, layer_id) for glyph_name, layer_id in keys
+            for c in self._layer(glyph_name, layer_id).components
+        ]
+        if referenced:
+            self.prefetch(referenced)
+        layers = [self._layer(*key) for key in keys]
+        for key, layer, items in zip(keys, layers, self._path_items(layers)):
+            layer_id = key[1]
+            for comp in layer.components:
+                if (item := _component_item(comp, self._bounds[comp.name, layer_id])):
+                    items.append(item)
+            self._bounds[key] = _layer_bounds(items)
+
+    def _layer(self, glyph_name: str, layer_id: str) -> GSLayer:
+        return self.font.glyphs[glyph_name].layers[layer_id]
+
+    @staticmethod
+    def _path_items(layers: list[GSLayer]) -> list[list[tuple]]:
+        '''Return the `(left, bottom, right, top)` of each path of each layer.'''
+        # Line segments with shape (segments, 2 points, 2) and cubic segments with shape
+        # (segments, 4 points, 2), with the path index of each segment
+        lines, line_paths, curves, curve_paths = [], [], [], []
+        path_layers = []
+        for i, layer in enumerate(layers):
+            for path in layer.paths:
+                for segment in _segments(path):
+                    if len(segment) == 2:
+                        lines.append(segment)
+                        line_paths.append(len(path_layers))
+                    else:
+                        curves.append(segment)
+                        curve_paths.append(len(path_layers))
+                path_layers.append(i)
+        mins = np.full((len(path_layers), 2), np.inf)
+        maxs = np.full((len(path_layers), 2), -np.inf)
+        if lines:
+            points = np.array(lines, dtype=float)
+            np.minimum.at(mins, line_paths, points.min(axis=1))
+            np.maximum.at(maxs, line_paths, points.max(axis=1))
+        if curves:
+            curve_mins, curve_maxs = _curve_bounds(np.array(curves, dtype=float))
+            np.minimum.at(mins, curve_paths, curve_mins)
+            np.maximum.at(maxs, curve_paths, curve_maxs)
+        # `GSLayer.bounds` gets the right and top from the size of `GSPath.bounds`.
+        maxs = mins + (maxs - mins)
+        result = [[] for _ in layers]
+        for i, lo, hi in zip(path_layers, mins.tolist(), maxs.tolist()):
+            result[i].append((*lo, *hi))
+        return result
+
+
+def _segments(path) -> list[list[tuple]]:
+    '''Return the points of the segments of `path`, in the same order as `GSPath.segments`.'''
+    nodes = list(path.nodes)
+    # Cycle node list until curve or line at start
+    start = next((i for i, n in enumerate(nodes) if n.type in (CURVE, LINE)), None)
+    if start is None:
+        return []
+    nodes = nodes[start:] + nodes[:start]
+    points = [(n.position.x, n.position.y) for n in nodes]
+    segments = []
+    for i, node in enumerate(nodes):
+        if node.type == CURVE:
+            segments.append([points[(i + j) % len(nodes)] for j in range(-3, 1)])
+        elif node.type == LINE:
+            segments.append([points[i - 1], points[i]])
+        elif node.type != OFFCURVE:
+            raise ValueError(f'Unsupported node type "{node.type}" in {path.parent}.')
+    if not path.closed:
+        segments.pop(0)
+    return segments
+
+
+def _curve_bounds(curves: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''Return the min and max points of cubic bezier `curves` with shape (curves, 4, 2). The
+    arithmetic is the same as `glyphsLib.classes.segment.bezierMinMax()`.
+    '''
+    p0, p1, p2, p3 = (curves[:, i] for i in range(4))
+    b = 6 * p0 - 12 * p1 + 6 * p2
+    a = -3 * p0 + 9 * p1 - 9 * p2 + 3 * p3
+    c = 3 * p1 - 3 * p0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        linear = np.abs(a) < 1e-12
+        t_linear = np.where(np.abs(b) < 1e-12, np.nan, -c / b)
+        sqrt_b2ac = np.sqrt(b * b - 4 * c * a)
+        t1 = (-b + sqrt_b2ac) / (2 * a)
+        t2 = (-b - sqrt_b2ac) / (2 * a)
+    # Extreme parameters for x and y, with shape (curves, 4)
+    t = np.concatenate([np.where(linear, t_linear, t1), np.where(linear, np.nan, t2)], axis=1)
+    t[~((0 < t) & (t < 1))] = np.nan
+    t = t[:, :, np.newaxis]
+    mt = 1 - t
+    values = (
+        (mt * mt * mt * p0[:, np.newaxis])
+        + (3 * mt * mt * t * p1[:, np.newaxis])
+        + (3 * mt * t * t * p2[:, np.newaxis])
+        + (t * t * t * p3[:, np.newaxis])
+    )
+    values = np.concatenate([values, p0[:, np.newaxis], p3[:, np.newaxis]], axis=1)
+    return np.nanmin(values, axis=1), np.nanmax(values, axis=1)
+
+
+def _component_item(comp, bounds: Bounds) -> tuple:
+    '''Return the `(left, bottom, right, top)` of a component from the bounds of the layer it
+    references, the same as `GSComponent.bounds` (which ignores rotation).
+    '''
+    if bounds is None:
+        return None
+    left, bottom, width, height = bounds
+    right, top = left + width, bottom + height
+    left, bottom = left * comp.scale[0] + comp.position.x, bottom * comp.scale[1] + comp.position.y
+    right, top = right * comp.scale[0] + comp.position.x, top * comp.scale[1] + comp.position.y
+    # Through `Rect`, as `GSLayer.bounds` gets the right and top from the size.
+    return (left, bottom, left + (right - left), bottom + (top - bottom))
+
+
+def _layer_bounds(items: list[tuple]) -> Bounds:
+    if not items:
+        return None
+    left = min(i[0] for i in items)
+    bottom = min(i[1] for i in items)
+    right = max(i[2] for i in items)
+    top = max(i[3] for i in items)
+    return (left, bottom, right - left, top - bottom)
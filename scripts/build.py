@@ -1,12 +1,22 @@
 '''Build FiraMath.glyphspackage.
 '''
 
+import argparse
+import contextlib
 import copy
+import datetime
 import functools
+import gc
+import json
 import multiprocessing
 import os
+import pickle
+import re
 import sys
+import tempfile
 import time
+import traceback
+import zlib
 
 import fontmake
 from fontmake.font_project import FontProject, GLYPHS_PREFIX, GLYPH_EXPORT_KEY, PUBLIC_PREFIX
@@ -14,25 +24,104 @@ from fontmake.instantiator import Instantiator
 
 import fontTools
 from fontTools.designspaceLib import DesignSpaceDocument, InstanceDescriptor
+from fontTools.misc.transform import Identity, Transform
 from fontTools.ttLib import TTFont
+from fontTools.ttLib.tables.DefaultTable import DefaultTable
+from fontTools.ttLib.tables import otTables
 from fontTools.ttLib.ttFont import newTable
 
 import glyphsLib
 from glyphsLib import GSComponent, GSFont, GSGlyph, GSLayer, GSNode, GSPath, glyphdata
 
-import toml
+import openstep_plist
+from ufo2ft.postProcessor import PostProcessor
 
-from math_table import MathTable, MathTableInstantiator
+import glyphs_package
+import math_spec
+from bounds import BoundsCache
+from build_cache import BuildCache
+from incremental_otf import IncrementalCompiler
+from math_table import MathGlyphClosure, MathTable, MathTableInstantiator, merge_var_store
+from profiling import PROFILERS, InstanceTimer, Metrics, profile, profile_path
+from smart_components import SmartGlyph
+from web_fonts import Subsetter, build_web_fonts
+
+
+# Keys of the MATH values in the userData of master layers
+MATH_USER_DATA_KEYS = ('italicCorrection', 'topAccent', 'startConnector', 'endConnector')
+
+# Anchor name prefixes of the cut-in kerning (as in the Glyphs MATH plugin) -> corner
+MATH_KERN_ANCHORS = {
+    'math.tr': 'TopRight',
+    'math.tl': 'TopLeft',
+    'math.br': 'BottomRight',
+    'math.bl': 'BottomLeft',
+}
+
+# The scripts the outputs (and the preprocessed font snapshots) depend on
+BUILD_SCRIPTS = (
+    'bounds.py',
+    'build.py',
+    'build_cache.py',
+    'glyphs_package.py',
+    'incremental_otf.py',
+    'math_spec.py',
+    'math_table.py',
+    'profiling.py',
+    'smart_components.py',
+    'web_fonts.py',
+)
+
+# Input and output hashes of the fonts in the output directory, see `_write_manifest()`
+MANIFEST_FILE_NAME = 'manifest.json'
+
+# Stages that `build()` can run alone: generate the UFO instances, compile the OTFs (without
+# MATH table), add the MATH table to the existing OTFs, or generate web fonts from them.
+STAGES = ('ufo', 'otf', 'math', 'web')
+
+# `sub a from [a.ssty1 a.ssty2];` or `sub a by b;` in the feature code
+_SUBSTITUTION_RE = re.compile(r'\bsub\s+([\w.\-]+)\s+(?:from|by)\s+\[?([\w.\-\s]+?)\]?\s*;')
 
 
 class Font:
 
-    def __init__(self, path: str):
-        self.font: GSFont = glyphsLib.load(path)
+    def __init__(
+        self,
+        path: str,
+        glyph_names: list[str] = None,
+        processes: int = None,
+        snapshot_dir: str = None,
+    ):
+        '''Load the Glyphs source `path`. For `.glyphspackage` directories, `glyph_names` can be
+        used to only load these glyphs (and the glyphs referenced by them), and the `.glyph` files
+        are parsed by `processes` processes.
+
+        If `snapshot_dir` is specified, the preprocessed font is saved there, and loaded directly
+        next time if none of the source files changed.
+        '''
+        snapshot_path = None
+        if snapshot_dir and glyph_names is None and os.path.isdir(path):
+            snapshot_path = self._snapshot_path(path, snapshot_dir)
+        # Whether the preprocessed font is loaded from the snapshot
+        self.from_snapshot = bool(snapshot_path) and os.path.isfile(snapshot_path)
+        if self.from_snapshot:
+            self._load_snapshot(snapshot_path)
+        else:
+            if os.path.isdir(path):
+                self.font: GSFont = glyphs_package.load(path, glyph_names, processes)
+            else:
+                self.font: GSFont = glyphsLib.load(path)
+            self.production_names: dict[str, str] = {
+                g.name: glyphdata.get_glyph(g.name).production_name
+                for g in self.font.glyphs
+            }
+        # Only a subset of glyphs is loaded
+        self.is_subset = glyph_names is not None
         self.math_tables = {}
         masters = sorted(self.font.masters, key=lambda m: m.weightValue)
         self._masters_num = len(masters)
         self._master_id_indices = {m.id: i for i, m in enumerate(masters)}
+        self._master_locations = [m.weightValue for m in masters]
         self.interpolations: dict[str, tuple] = {
             i.name: [
                 (self._master_id_indices[id], value)
@@ -40,11 +129,79 @@ class Font:
             ]
             for i in self.font.instances if i.active
         }
-        self.production_names: dict[str, str] = {
-            g.name: glyphdata.get_glyph(g.name).production_name
-            for g in self.font.glyphs
+        self._build_indexes()
+        if not self.from_snapshot:
+            with _gc_paused():
+                self._decompose_smart_comp()
+            if snapshot_path:
+                self._save_snapshot(snapshot_path)
+
+    def _build_indexes(self):
+        '''Index the layers and instances by name / ID, so that the lookups in decomposition and
+        MATH data extraction don't scan the lists again and again.
+
+        The indexes hold the layer objects themselves, so they stay valid when the layers are
+        modified by decomposition.
+        '''
+        # Glyph name -> layer ID -> layer
+        self._layers: dict[str, dict[str, GSLayer]] = {}
+        # Glyph name -> master layers, sorted by weight
+        self._sorted_master_layers: dict[str, list[GSLayer]] = {}
+        for glyph in self.font.glyphs:
+            layers = {}
+            for layer in glyph.layers:
+                layers.setdefault(layer.layerId, layer)
+            self._layers[glyph.name] = layers
+            self._sorted_master_layers[glyph.name] = sorted(
+                (l for l in layers.values() if l.associatedMasterId == l.layerId),
+                key=lambda l: self._master_id_indices[l.associatedMasterId]
+            )
+        # (glyph name, master ID) -> untransformed outline, see `_outline()`
+        self._outlines: dict[tuple[str, str], list[tuple]] = {}
+        # Style name -> instance
+        self._instances: dict[str, object] = {}
+        for instance in self.font.instances:
+            self._instances.setdefault(instance.name, instance)
+        self._build_user_data_index()
+        # Bounds of layers, computed on demand
+        self.bounds = BoundsCache(self.font)
+        # Smart glyph name -> `SmartGlyph`, with its `partSelection` index
+        self._smart_glyphs: dict[str, SmartGlyph] = {
+            g.name: SmartGlyph(g) for g in self.font.glyphs if self._is_smart_glyph(g)
+        }
+
+    @staticmethod
+    def _snapshot_path(path: str, snapshot_dir: str) -> str:
+        source_hashes = {
+            os.path.relpath(file_path, path): value
+            for file_path, value in BuildCache.source_hashes(path).items()
         }
-        self._decompose_smart_comp()
+        key = BuildCache.hash_values(
+            sys.version, glyphsLib.__version__, sorted(_script_hashes().values()), source_hashes
+        )
+        return os.path.join(snapshot_dir, f'{key}.snapshot')
+
+    def _load_snapshot(self, snapshot_path: str):
+        with open(snapshot_path, 'rb') as f:
+            data = zlib.decompress(f.read())
+        with _gc_paused():
+            self.font, self.production_names = pickle.loads(data)
+
+    def _save_snapshot(self, snapshot_path: str):
+        '''Save the font after preprocessing, i.e. the result of `Font.__init__()`. The snapshots
+        of other versions of the sources are removed.
+        '''
+        snapshot_dir = os.path.dirname(snapshot_path)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        for file_name in os.listdir(snapshot_dir):
+            if file_name.endswith('.snapshot'):
+                os.remove(os.path.join(snapshot_dir, file_name))
+        with _gc_paused():
+            data = pickle.dumps((self.font, self.production_names), pickle.HIGHEST_PROTOCOL)
+        tmp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(data, 1))
+        os.replace(tmp_path, snapshot_path)
 
     def _decompose_smart_comp(self):
         '''Decompose smart components.
@@ -53,24 +210,38 @@ class Font:
         # The smart glyphs should be decomposed first.
         for glyph in filter(self._is_smart_glyph, self.font.glyphs):
             for layer in glyph.layers:
-                to_be_removed = []
+                removed = set()
                 for comp in layer.components:
                     if self._is_smart_component(comp):
-                        paths = self._smart_component_to_paths(comp)
+                        # Not `self._smart_glyphs`, whose part arrays must be packed after
+                        # all the smart glyphs are decomposed.
+                        paths = SmartGlyph(comp.component).to_paths([comp])[0]
                     else:
                         paths = self._component_to_paths(comp)
                     layer.paths.extend(paths)
-                    to_be_removed.append(comp)
-                layer._shapes = [s for s in layer._shapes if s not in to_be_removed]
-        for glyph in filter(lambda g: not self._is_smart_glyph(g), self.font.glyphs):
+                    removed.add(id(comp))
+                if removed:
+                    layer._shapes = [s for s in layer._shapes if id(s) not in removed]
+        # Then interpolate all the smart components referencing the same smart glyph at once.
+        smart_comps: dict[str, list[GSComponent]] = {}
+        layers: dict[int, GSLayer] = {}
+        for glyph in self.font.glyphs:
+            if self._is_smart_glyph(glyph):
+                continue
             for layer in glyph.layers:
-                to_be_removed = []
                 for comp in layer.components:
                     if comp.smartComponentValues:
-                        paths = self._smart_component_to_paths(comp)
-                        layer.paths.extend(paths)
-                        to_be_removed.append(comp)
-                layer._shapes = [s for s in layer._shapes if s not in to_be_removed]
+                        smart_comps.setdefault(comp.componentName, []).append(comp)
+                        layers[id(layer)] = layer
+        comp_paths: dict[int, list[GSPath]] = {}
+        for name, comps in smart_comps.items():
+            for comp, paths in zip(comps, self._smart_glyphs[name].to_paths(comps)):
+                comp_paths[id(comp)] = paths
+        for layer in layers.values():
+            for comp in layer.components:
+                if id(comp) in comp_paths:
+                    layer.paths.extend(comp_paths[id(comp)])
+            layer._shapes = [s for s in layer._shapes if id(s) not in comp_paths]
 
     @staticmethod
     def _is_smart_glyph(glyph: GSGlyph) -> bool:
@@ -80,82 +251,80 @@ class Font:
     def _is_smart_component(comp: GSComponent) -> bool:
         return Font._is_smart_glyph(comp.component)
 
-    @staticmethod
-    def _smart_component_to_paths(comp: GSComponent) -> list[GSPath]:
-        '''Return the paths of a smart component `comp` by interpolating between two layers.
-        Note that we only consider single smart component axis here.
+    def _component_to_paths(self, comp: GSComponent) -> list[GSPath]:
+        '''Return the paths of a normal component `comp`, i.e. decompose `comp`.'''
+        return self._transformed_paths(
+            self._outline(comp.componentName, comp.parent.associatedMasterId),
+            Transform(*comp.transform),
+        )
+
+    def _outline(self, glyph_name: str, master_id: str) -> list[tuple]:
+        '''Return the untransformed outline of the master layer of `glyph_name`, as a list of
+        `(path, [(position, node type, smooth), ...])`. Nested (non-smart) components are
+        decomposed as well. The result is memoized, as the same glyphs are referenced many times.
         '''
-        values: dict = comp.smartComponentValues
-        master_id: str = comp.parent.associatedMasterId
-        ref_glyph: GSGlyph = comp.component
-        if len(values) == 0:
-            interpolation_value = 0
-            def _is_part_n(layer, n):
-                return (
-                    layer.associatedMasterId == master_id and
-                    layer.partSelection[next(iter(layer.partSelection.keys()))] == n
+        key = (glyph_name, master_id)
+        if key not in self._outlines:
+            layer = self._layers[glyph_name][master_id]
+            outline = [
+                (path, [((n.position.x, n.position.y), n.type, n.smooth) for n in path.nodes])
+                for path in layer.paths
+            ]
+            # Nested smart components are not supported, and are skipped.
+            for comp in (c for c in layer.components if not self._is_smart_component(c)):
+                transform = Transform(*comp.transform)
+                outline.extend(
+                    (path, [(transform.transformPoint(p), t, s) for p, t, s in nodes])
+                    for path, nodes in self._outline(comp.componentName, master_id)
                 )
-        elif len(values) == 1:
-            key, value = next(iter(values.items()))
-            interpolation_value = next(
-                Font._rescale(value, axis.bottomValue, axis.topValue)
-                for axis in ref_glyph.smartComponentAxes if axis.name == key
-            )
-            def _is_part_n(layer, n):
-                return layer.associatedMasterId == master_id and layer.partSelection[key] == n
-        else:
-            raise ValueError('We only support single smart component axis!')
-        layer_0: GSLayer = next(layer for layer in ref_glyph.layers if _is_part_n(layer, 1))
-        layer_1: GSLayer = next(layer for layer in ref_glyph.layers if _is_part_n(layer, 2))
-        paths = []
-        for path_0, path_1 in zip(layer_0.paths, layer_1.paths):
-            path = Font._interpolate_path(path_0, path_1, interpolation_value)
-            path.applyTransform(comp.transform)
-            paths.append(path)
-        return paths
-
-    @staticmethod
-    def _rescale(x, bottom, top):
-        '''Return rescaled `x` to run from 0 to 1 over the range `bottom` to `top`.'''
-        return (x - bottom) / (top - bottom)
+            self._outlines[key] = outline
+        return self._outlines[key]
 
     @staticmethod
-    def _interpolate_path(path_0: GSPath, path_1: GSPath, value) -> GSPath:
-        new_path = copy.copy(path_0)
-        new_path.nodes = []
-        for node_0, node_1 in zip(path_0.nodes, path_1.nodes):
-            new_path.nodes.append(Font._interpolate_node(node_0, node_1, value))
-        return new_path
-
-    @staticmethod
-    def _interpolate_node(node_0: GSNode, node_1: GSNode, value) -> GSNode:
-        position = (
-            round(node_0.position.x * (1 - value) + node_1.position.x * value),
-            round(node_0.position.y * (1 - value) + node_1.position.y * value),
-        )
-        return GSNode(position, type=node_0.type, smooth=node_0.smooth)
-
-    @staticmethod
-    def _component_to_paths(comp: GSComponent) -> list[GSPath]:
-        '''Return the paths of a normal component `comp`, i.e. decompose `comp`.'''
-        ref_glyph: GSGlyph = comp.component
-        paths = next(
-            layer.paths for layer in ref_glyph.layers
-            if layer.layerId == comp.parent.associatedMasterId
-        )
+    def _transformed_paths(outline: list[tuple], transform: Transform) -> list[GSPath]:
         result = []
-        for path in paths:
+        for path, nodes in outline:
             # Manually deepcopy (`copy.deepcopy()` is very slow here).
             new_path = copy.copy(path)
-            new_path.nodes = [GSNode(n.position, type=n.type, smooth=n.smooth) for n in path.nodes]
-            new_path.applyTransform(comp.transform)
+            if transform == Identity:
+                new_path.nodes = [GSNode(p, type=t, smooth=s) for p, t, s in nodes]
+            else:
+                new_path.nodes = [
+                    GSNode(transform.transformPoint(p), type=t, smooth=s) for p, t, s in nodes
+                ]
             result.append(new_path)
         return result
 
-    def to_ufos(self, interpolate: bool = True, default_index: int = None) -> list:
-        master_ufos, instance_data = glyphsLib.to_ufos(self.font, include_instances=True)
+    def to_ufos(
+        self,
+        interpolate: bool = True,
+        default_index: int = None,
+        styles: list[str] = None,
+    ) -> list:
+        '''Return the UFO instances, or only those of `styles` if specified.'''
         if not interpolate:
+            master_ufos, _ = glyphsLib.to_ufos(self.font, include_instances=True)
             return master_ufos
+        instantiator, instances = self.instantiator(default_index, styles)
+        return [self._generate_instance(instantiator, i) for i in instances]
+
+    def instantiator(
+        self,
+        default_index: int = None,
+        styles: list[str] = None,
+    ) -> tuple[Instantiator, list[InstanceDescriptor]]:
+        '''Return the instantiator of the master UFOs, and the descriptors of the instances (or
+        only those of `styles` if specified). The instances are generated by
+        `_generate_instance()`, possibly in other processes.
+        '''
+        designspace = self._designspace(default_index)
+        instantiator = Instantiator.from_designspace(designspace)
+        return instantiator, [
+            i for i in designspace.instances if styles is None or i.styleName in styles
+        ]
+
+    def _designspace(self, default_index: int = None) -> DesignSpaceDocument:
+        _, instance_data = glyphsLib.to_ufos(self.font, include_instances=True)
         designspace = self._to_designspace(instance_data)
         if default_index:
             designspace.default = designspace.sources[default_index]
@@ -172,8 +341,85 @@ class Font:
             designspace.axes[axis_index].default = next(
                 i.axes[axis_index] for i in self.font.instances if isinstance(i.weight, str)
             )
-        instantiator = Instantiator.from_designspace(designspace)
-        return [self._generate_instance(instantiator, i) for i in designspace.instances]
+        return designspace
+
+    def build_variable_font(self, output_path: str):
+        '''Compile a CFF2 variable font from the masters to `output_path`.'''
+        designspace = self._designspace()
+        for axis in designspace.axes:
+            # A variable font can't extrapolate, so the axis stops at the extreme masters, and the
+            # named instances beyond them (e.g. Ultra) are left out.
+            locations = [s.location[axis.name] for s in designspace.sources]
+            axis.minimum = max(axis.minimum, min(locations))
+            axis.maximum = min(axis.maximum, max(locations))
+            # The designspace splitting of varLib needs a list.
+            axis.map = []
+        designspace.instances = [
+            i for i in designspace.instances
+            if all(a.minimum <= i.designLocation[a.name] <= a.maximum for a in designspace.axes)
+        ]
+        FontProject().build_variable_fonts(
+            designspace, output_path=output_path, ttf=False, optimize_cff=2
+        )
+
+    def add_variable_math_table(
+        self,
+        toml_path: str,
+        input_path: str,
+        output_path: str = None,
+        data: dict[str] = None,
+    ):
+        '''Add the variable MATH table to the variable font `input_path`, and normalize glyph
+        names. `data` is the MATH table data of `toml_path` if already loaded by `math_spec()`.
+
+        The values of `MathValueRecord`s vary with the weight, using VariationIndex device tables
+        into the `VarStore` of GDEF.
+        '''
+        instantiator = MathTableInstantiator(
+            self._parse_master_data(toml_path, data), self._master_locations
+        )
+        with TTFont(input_path) as tt_font, TTFont(input_path) as original_font:
+            axis = original_font['fvar'].axes[0]
+            math_table, var_store = instantiator.generate_variable(
+                axis.axisTag, (axis.minValue, axis.defaultValue, axis.maxValue)
+            )
+            # Compile MATH and GDEF with the original glyph names first, then rename the glyphs.
+            gdef = self._gdef_with_var_store(original_font)
+            var_index_map = merge_var_store(gdef.table.VarStore, var_store)
+            math = newTable('MATH')
+            math.table = math_table.encode(var_index_map)
+            for tag, table in (('GDEF', gdef), ('MATH', math)):
+                tt_font[tag] = DefaultTable(tag)
+                tt_font[tag].data = table.compile(original_font)
+            PostProcessor.rename_glyphs(tt_font, {
+                g: self.production_names.get(g, g) for g in tt_font.getGlyphOrder()
+            })
+            tt_font.save(output_path or input_path)
+
+    @staticmethod
+    def _gdef_with_var_store(tt_font: TTFont):
+        '''Return the GDEF table of `tt_font` (a new one if missing) with a `VarStore`.'''
+        if 'GDEF' in tt_font:
+            gdef = tt_font['GDEF']
+        else:
+            gdef = newTable('GDEF')
+            gdef.table = otTables.GDEF()
+            for name in ('GlyphClassDef', 'AttachList', 'LigCaretList', 'MarkAttachClassDef'):
+                setattr(gdef.table, name, None)
+        table = gdef.table
+        if table.Version < 0x00010002:
+            table.MarkGlyphSetsDef = None
+        if table.Version < 0x00010003 or table.VarStore is None:
+            table.Version = 0x00010003
+            table.VarStore = otTables.VarStore()
+            table.VarStore.Format = 1
+            table.VarStore.VarRegionList = otTables.VarRegionList()
+            table.VarStore.VarRegionList.RegionAxisCount = len(tt_font['fvar'].axes)
+            table.VarStore.VarRegionList.Region = []
+            table.VarStore.VarRegionList.RegionCount = 0
+            table.VarStore.VarData = []
+            table.VarStore.VarDataCount = 0
+        return gdef
 
     @staticmethod
     def _to_designspace(instance_data: dict) -> DesignSpaceDocument:
@@ -197,37 +443,106 @@ class Font:
             glyph.lib[GLYPH_EXPORT_KEY] = False
         return ufo
 
-    def add_math_table(self, toml_path: str, input_dir: str, output_dir: str = None):
+    def add_math_table(
+        self,
+        toml_path: str,
+        input_dir: str,
+        output_dir: str = None,
+        styles: list[str] = None,
+        parallel: bool = True,
+        processes: int = None,
+        data: dict[str] = None,
+    ):
+        '''Add the MATH table to the fonts of `styles` (default to all) in `input_dir`, in a
+        pool of `processes` processes if `parallel`. A failed style doesn't stop the others; the
+        errors are raised together as a `BuildError` at the end. `data` is the MATH table data
+        of `toml_path` if already loaded by `math_spec()`.
+        '''
         if not output_dir:
             output_dir = input_dir
         if not os.path.isdir(output_dir):
             os.mkdir(output_dir)
-        self.math_tables = self._parse_math_table(toml_path)
-        for style in self.interpolations:
-            font_file_name = self._font_file_name(style)
-            eprint(f'=> {font_file_name}')
-            input_path = os.path.join(input_dir, font_file_name)
-            output_path = os.path.join(output_dir, font_file_name)
-            self._write_math_table(style, input_path, output_path)
-            self._normalize_glyph_names(output_path, output_path)
-
-    def _parse_math_table(self, toml_path: str) -> dict[str, MathTable]:
-        master_data = self._parse_master_data(toml_path)
-        return {
-            style: MathTableInstantiator(
-                master_data,
-                interpolation,
-                self._removed_glyphs(style),
-            ).generate()
-            for style, interpolation in self.interpolations.items()
+        styles = styles or list(self.interpolations)
+        self.math_tables = self._parse_math_table(toml_path, styles, data)
+        tasks = [
+            (
+                self.math_tables[style],
+                self.production_names,
+                os.path.join(input_dir, self._font_file_name(style)),
+                os.path.join(output_dir, self._font_file_name(style)),
+            )
+            for style in styles
+        ]
+        errors = {}
+        results = map_with_errors(_postprocess, tasks, parallel, processes)
+        for style, (_, error) in zip(styles, results):
+            _report(self._font_file_name(style), error)
+            if error:
+                errors[style] = error
+        if errors:
+            raise BuildError(errors)
+
+    def _parse_math_table(
+        self,
+        toml_path: str,
+        styles: list[str] = None,
+        data: dict[str] = None,
+    ) -> dict[str, MathTable]:
+        instantiator = MathTableInstantiator(
+            self._parse_master_data(toml_path, data), self._master_locations
+        )
+        return instantiator.generate_all(
+            {
+                style: interpolation for style, interpolation in self.interpolations.items()
+                if styles is None or style in styles
+            },
+            {style: self._removed_glyphs(style) for style in self.interpolations},
+        )
+
+    def math_glyph_closure(self, toml_path: str, style: str = None) -> MathGlyphClosure:
+        '''Return the `MathGlyphClosure` of the code points of `style` (default to all the
+        exported glyphs), from the MATH table data and the substitutions of the feature code.
+        Only the glyph names are needed, so no glyph metrics are computed.
+
+        The glyph names are the ones of the source; `production_names` maps them to the ones of
+        the fonts.
+        '''
+        data = self.math_spec(toml_path)
+        removed_glyphs = set(style and self._removed_glyphs(style) or ())
+        cmap = {
+            int(u, 16): glyph.name for glyph in self.font.glyphs
+            if glyph.export and glyph.name not in removed_glyphs for u in glyph.unicodes
         }
+        return MathGlyphClosure(data['MathVariants'], cmap, self._feature_alternates())
+
+    def _feature_alternates(self) -> dict[str, list[str]]:
+        '''Return the glyphs substituted for each glyph by the feature code.'''
+        result = {}
+        for feature in self.font.features:
+            for glyph, alternates in _SUBSTITUTION_RE.findall(feature.code):
+                result.setdefault(glyph, []).extend(alternates.split())
+        return result
 
     def _removed_glyphs(self, style: str) -> list[str]:
-        instance = next(i for i in self.font.instances if i.name == style)
-        return instance.customParameters['Remove Glyphs']
+        return self._instances[style].customParameters['Remove Glyphs']
+
+    def math_spec(self, toml_path: str) -> dict[str]:
+        '''Return the MATH table data of `toml_path` (see `math_spec.load()`), without the glyphs
+        not loaded. Raise `MathSpecError` if it references glyphs not in the font.
+        '''
+        data = math_spec.load(toml_path)
+        if self.is_subset:
+            self._subset_master_data(data)
+        elif errors := math_spec.undefined_glyphs(data, self._layers):
+            raise math_spec.MathSpecError(toml_path, errors)
+        return data
 
-    def _parse_master_data(self, toml_path: str) -> dict[str]:
-        data = self._toml_parse(toml_path)
+    def _parse_master_data(self, toml_path: str, data: dict[str] = None) -> dict[str]:
+        '''Return the MATH table data of `toml_path` with the values of the masters. `data` is
+        the data already loaded by `math_spec()` (if any), which is modified in place.
+        '''
+        if data is None:
+            data = self.math_spec(toml_path)
         glyph_info = data['MathGlyphInfo']
         variants = data['MathVariants']
         for name in glyph_info:
@@ -239,6 +554,13 @@ class Font:
                     )
                     values = [values[0]] * self._masters_num
                 glyph_info[name][glyph] = values
+        glyph_info['MathKernInfo'] = self._math_kerns()
+        self._prefetch_bounds(
+            [var for key in ('HorizontalVariants', 'VerticalVariants')
+             for value in variants[key].values() for var in value]
+            + [part['name'] for key in ('HorizontalComponents', 'VerticalComponents')
+               for value in variants[key].values() for part in value['parts']]
+        )
         for glyph, value in variants['HorizontalVariants'].items():
             variants['HorizontalVariants'][glyph] = {
                 var: self._advances(var, 'H', plus_1=True) for var in value
@@ -257,108 +579,192 @@ class Font:
             ]
         return data
 
-    @staticmethod
-    def _toml_parse(toml_path: str) -> dict[str]:
-        data = toml.load(toml_path)
-        data['MathGlyphInfo']['ExtendedShapes'] = \
-            Font._glyph_names_expand(data['MathGlyphInfo']['ExtendedShapes'])
+    def _subset_master_data(self, data: dict[str]):
+        '''Remove the glyphs not loaded from the MATH table data, in place.'''
+        glyph_info = data['MathGlyphInfo']
+        variants = data['MathVariants']
+        for name, value in glyph_info.items():
+            if isinstance(value, list):
+                glyph_info[name] = [g for g in value if g in self._layers]
+            else:
+                glyph_info[name] = {g: v for g, v in value.items() if g in self._layers}
         for key in ('HorizontalVariants', 'VerticalVariants'):
-            for glyph, variants in data['MathVariants'][key].items():
-                data['MathVariants'][key][glyph] = Font._string_expand(variants)
-        return data
-
-    @staticmethod
-    def _glyph_names_expand(names: list[str]) -> list[str]:
-        res = []
-        for s in names:
-            res.extend(Font._string_expand(s))
-        return res
-
-    @staticmethod
-    def _string_expand(s: str) -> list[str]:
-        try:
-            (base, suffix) = s.split('?')
-            return [base] + [base + i for i in Font._string_expand_hash(suffix)]
-        except ValueError:
-            return Font._string_expand_hash(s)
+            variants[key] = {
+                glyph: [var for var in value if var in self._layers]
+                for glyph, value in variants[key].items() if glyph in self._layers
+            }
+        for key in ('HorizontalComponents', 'VerticalComponents'):
+            variants[key] = {
+                glyph: value for glyph, value in variants[key].items()
+                if glyph in self._layers and all(p['name'] in self._layers for p in value['parts'])
+            }
 
-    @staticmethod
-    def _string_expand_hash(s: str) -> list[str]:
-        try:
-            (base, num) = s.split('#')
-            return [f'{base}{i:02}' for i in range(1, int(num) + 1)]
-        except ValueError:
-            return [s]
+    def _math_kerns(self) -> dict[str, dict[str]]:
+        '''Return the cut-in kerning of the exported glyphs, from the `MATH_KERN_ANCHORS` of
+        their master layers. For each corner, the anchors sorted by height give the kern values
+        (the horizontal distances to the advance width on the right, or to the origin on the
+        left), and the heights between them, with the values of all the masters.
+        '''
+        result = {}
+        for glyph, layers in self._sorted_master_layers.items():
+            # Corner -> (height, kern value) of the anchors of each master layer
+            points: dict[str, list[list[tuple]]] = {}
+            for i, layer in enumerate(layers):
+                for anchor in layer.anchors:
+                    side = MATH_KERN_ANCHORS.get(anchor.name[:7])
+                    if side is None:
+                        continue
+                    x, y = anchor.position.x, anchor.position.y
+                    kern = x - layer.width if side.endswith('Right') else -x
+                    points.setdefault(side, [[] for _ in layers])[i].append((y, kern))
+            if not points or not self.font.glyphs[glyph].export:
+                continue
+            kerns = {}
+            for side, master_points in points.items():
+                if len(layers) != self._masters_num or len(set(map(len, master_points))) > 1:
+                    eprint(
+                        f'Warning: glyph "{glyph}" has incompatible math kern anchors '
+                        f'({side}: {[len(p) for p in master_points]}).'
+                    )
+                    continue
+                master_points = [sorted(p) for p in master_points]
+                n = len(master_points[0])
+                kerns[side] = {
+                    # The last height is not used: its kern value applies to all the heights
+                    # above the previous one.
+                    'correctionHeights': [
+                        [round(p[i][0]) for p in master_points] for i in range(n - 1)
+                    ],
+                    'kernValues': [[round(p[i][1]) for p in master_points] for i in range(n)],
+                }
+            if kerns:
+                result[glyph] = kerns
+        return result
 
     def _get_all_user_data(self, name: str) -> dict[str, list]:
         # Uncapitalize: 'TopAccent' -> 'topAccent', etc.
         name = name[0].lower() + name[1:]
-        mappings = {}
-        for glyph in (g for g in self.font.glyphs if g.export):
-            if values := self._get_user_data(glyph, name):
-                mappings[glyph.name] = values
-        return mappings
-
-    def _get_user_data(self, glyph: GSGlyph, name: str) -> list:
-        values = []
-        for layer in self._master_layers(glyph.layers):
-            # Assume there is only one `name` in layer.userData
-            try:
-                data = next(d for d in layer.userData if name in d)
-                values.append(data[name])
-            except StopIteration:
-                pass
-        return values
-
-    def _master_layers(self, layers) -> list[GSLayer]:
-        return sorted(
-            (l for l in layers if l.associatedMasterId == l.layerId),
-            key=lambda l: self._master_id_indices[l.associatedMasterId]
-        )
+        return {
+            glyph: values for glyph, values in self._user_data.get(name, {}).items()
+            if self.font.glyphs[glyph].export
+        }
+
+    def _get_user_data(self, glyph: str, name: str) -> list:
+        return self._user_data.get(name, {}).get(glyph, [])
+
+    def master_user_data(self, key: str) -> dict[str, list]:
+        '''Return the values of the MATH value `key` (one of `MATH_USER_DATA_KEYS`) in the
+        master layers of each glyph which has it, sorted by weight. Non-exported glyphs are
+        included.
+        '''
+        return self._user_data[key]
+
+    def _build_user_data_index(self):
+        '''Collect the MATH values (`MATH_USER_DATA_KEYS`) in the userData of all the master
+        layers in a single pass. The index maps each key to glyph names to the values of the
+        master layers (sorted by weight); glyphs without the key are left out.
+        '''
+        self._user_data: dict[str, dict[str, list]] = {key: {} for key in MATH_USER_DATA_KEYS}
+        for glyph, layers in self._sorted_master_layers.items():
+            for layer in layers:
+                found = set()
+                # Iterating `userData` gives the values, which are dicts for plugin data.
+                for data in layer.userData:
+                    if not isinstance(data, dict):
+                        continue
+                    # Assume there is only one `key` in layer.userData
+                    for key in data.keys() & self._user_data.keys() - found:
+                        self._user_data[key].setdefault(glyph, []).append(data[key])
+                        found.add(key)
 
     def _advances(self, glyph: str, direction: str, plus_1: bool = False) -> list:
         result = []
-        for layer in self._master_layers(self.font.glyphs[glyph].layers):
-            size = layer.bounds.size
-            advance = size.width if direction == 'H' else size.height
+        for layer in self._sorted_master_layers[glyph]:
+            _, _, width, height = self.bounds.bounds(glyph, layer.layerId)
+            advance = width if direction == 'H' else height
             result.append(abs(round(advance)))
         if plus_1:
             return [i + 1 for i in result]
         return result
 
+    def _prefetch_bounds(self, glyphs: list[str]):
+        '''Compute the bounds of the master layers of `glyphs` in a batch.'''
+        self.bounds.prefetch([
+            (glyph, layer.layerId) for glyph in glyphs
+            for layer in self._sorted_master_layers[glyph]
+        ])
+
     def _variant_part(self, glyph: str, direction: str) -> dict[str, list]:
         result = {
-            name: self._get_user_data(self.font.glyphs[glyph], name)
+            name: self._get_user_data(glyph, name)
             for name in ['startConnector', 'endConnector']
         }
         result['fullAdvance'] = self._advances(glyph, direction)
         return result
 
     def _font_file_name(self, style: str) -> str:
-        font_name = self.font.familyName.replace(' ', '')
-        return f'{font_name}-{style}.otf'
+        return font_file_name(self.font.familyName, style)
 
-    def _write_math_table(self, style: str, input_path: str, output_path: str):
-        with TTFont(input_path) as tt_font:
-            tt_font['MATH'] = newTable('MATH')
-            tt_font['MATH'].table = self.math_tables[style].encode()
+    @staticmethod
+    def _postprocess(
+        math_table: MathTable,
+        production_names: dict[str, str],
+        input_path: str,
+        output_path: str,
+    ):
+        '''Add the MATH table and normalize glyph names, with a single load and save of the
+        font. The input can also be a finished font (e.g. to replace its MATH table), whose glyph
+        names are normalized already.
+        '''
+        # The new CFF strings only take effect if they are replaced before the charset is read,
+        # and then the glyph order of `tt_font` has the normalized names. So the MATH table,
+        # which uses the original names, is compiled against another copy of the font.
+        with TTFont(input_path) as tt_font, TTFont(input_path) as original_font:
+            # The glyphs of a finished font have their normalized names already (except the
+            # ones in the CFF standard strings, which are never renamed).
+            glyph_order = set(original_font.getGlyphOrder())
+            if names := {g: n for g, n in production_names.items() if g not in glyph_order}:
+                math_table = math_table.renamed(names)
+            Font._normalize_glyph_names(tt_font, production_names)
+            Font._write_math_table(tt_font, math_table, original_font)
             tt_font.save(output_path)
 
-    def _normalize_glyph_names(self, input_path: str, output_path: str):
+    @staticmethod
+    def _write_math_table(tt_font: TTFont, math_table: MathTable, original_font: TTFont = None):
+        table = newTable('MATH')
+        table.table = math_table.encode()
+        if original_font is None:
+            tt_font['MATH'] = table
+        else:
+            tt_font['MATH'] = DefaultTable('MATH')
+            tt_font['MATH'].data = table.compile(original_font)
+
+    @staticmethod
+    def _normalize_glyph_names(tt_font: TTFont, production_names: dict[str, str]):
         '''Normalize glyph names using AGL convention.'''
-        with TTFont(input_path) as tt_font:
-            cff = tt_font['CFF '].cff
-            cff.strings.strings = list(map(self._normalize_string, cff.strings.strings))
-            tt_font.save(output_path)
+        cff = tt_font['CFF '].cff
+        cff.strings.strings = [
+            Font._normalize_string(s, production_names) for s in cff.strings.strings
+        ]
 
-    def _normalize_string(self, s: str) -> str:
+    @staticmethod
+    def _normalize_string(s: str, production_names: dict[str, str]) -> str:
         # Ad-hoc treatment for copyright string
         if 'Copyright Copyright' in s:
             s = s.replace('Copyright Copyright', 'Copyright')  # For U+00A9 `©`
             s = s.replace('?', '-')  # For U+2013 `–`
             return s
         # For glyph names
-        return self.production_names.get(s, s)
+        return production_names.get(s, s)
+
+
+class BuildError(Exception):
+    '''Raised when some styles failed to build, after all the other styles are finished.'''
+
+    def __init__(self, errors: dict[str, str]):
+        # Style name -> traceback
+        self.errors = errors
+        super().__init__(f'Failed to build {len(errors)} style(s): {", ".join(errors)}')
 
 
 class Timer:
@@ -380,19 +786,118 @@ class Timer:
             eprint(f'Elapsed: {int(t) // 60}min{(t % 60):.3f}s\n')
 
 
+@contextlib.contextmanager
+def _gc_paused():
+    '''Disable garbage collection temporarily. Creating or pickling lots of objects is several
+    times faster without the collector repeatedly scanning them.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 def eprint(*values, sep: str = ' ', end: str = '\n'):
     '''Print message to `stderr`.'''
     print(*values, sep=sep, end=end, file=sys.stderr)
 
 
-def build(input_path: str, toml_path: str, output_dir: str, parallel: bool = True):
+def map_with_errors(
+    func,
+    items: list,
+    parallel: bool = True,
+    processes: int = None,
+    initializer=None,
+    initargs: tuple = (),
+):
+    '''Call `func` on each of `items`, in a pool of `processes` processes (default to the CPU
+    count) if `parallel`. Yield `(return value, error)` of each call in the order of `items`,
+    where `error` is `None`, or the formatted traceback if it raised an exception. A failed call
+    doesn't stop the others.
+    '''
+    func = functools.partial(_call_with_error, func)
+    if not parallel:
+        yield from map(func, items)
+        return
+    with multiprocessing.Pool(processes, initializer=initializer, initargs=initargs) as p:
+        yield from p.imap(func, items, chunksize=1)
+
+
+def _call_with_error(func, item) -> tuple:
+    try:
+        return func(item), None
+    except Exception:  # pylint: disable=broad-except
+        return None, traceback.format_exc()
+
+
+def font_file_name(family_name: str, style: str) -> str:
+    font_name = family_name.replace(' ', '')
+    return f'{font_name}-{style}.otf'
+
+
+def build(
+    input_path: str,
+    toml_path: str,
+    output_dir: str,
+    parallel: bool = True,
+    cache_dir: str = None,
+    use_cache: bool = True,
+    incremental: bool = False,
+    variable: bool = False,
+    styles: list[str] = None,
+    stage: str = None,
+    jobs: int = None,
+    glyph_names: list[str] = None,
+    web: bool = False,
+    metrics_path: str = None,
+    profiler: str = None,
+    profile_dir: str = None,
+):
     '''Build fonts from Glyphs source.
 
     1. Load the `.glyphspackage` directory into a `GSFont` object with preprocessing
     2. Convert the `GSFont` into a list of UFO objects and perform interpolation
     3. Generate `.otf` font files
     4. Add OpenType MATH table and normalize glyph names
+
+    Steps 2 to 4 run for each style independently in a pool of `jobs` processes (default to the
+    CPU count, see `_Pipeline`).
+
+    Fonts whose inputs are unchanged since a previous build are copied from the build cache
+    (`output_dir/.cache` by default) and skip all the steps above. After a successful build, the
+    least recently used entries beyond `BuildCache.MAX_SIZE` are removed. With `incremental`,
+    only the glyphs changed since the previous build are recompiled and spliced into the
+    previous OTF.
+
+    With `variable`, a single CFF2 variable font with a variable MATH table is built from the
+    masters instead of the static instances.
+
+    Only `styles` are built if specified. `stage` (one of `STAGES`) runs a single stage: `'ufo'`
+    saves the UFO instances, `'otf'` stops before the MATH table, and `'math'` adds the MATH
+    table to the OTFs already in `output_dir`, and `'web'` makes web fonts from them. With
+    `glyph_names`, only these glyphs (and the glyphs referenced by them) are built, e.g. for
+    quick proofs.
+
+    With `web`, a WOFF2 font, Unicode-range subsets and a CSS file are also written to
+    `output_dir/web` for each font (see `web_fonts`).
+
+    The fonts are reproducible: their timestamps are the date of the source (or
+    `SOURCE_DATE_EPOCH`), so the same inputs always give the same bytes. The input key and the
+    hash of each font are recorded in `output_dir/manifest.json`.
+
+    The timings of the stages and styles, peak memory, worker utilisation, glyph counts and
+    cache hit rates are written as JSON to `metrics_path` if specified (see `Metrics`). With
+    `profiler` (one of `PROFILERS`), each stage and style is profiled into `profile_dir`
+    (`output_dir/profiles` by default).
     '''
+    if stage is not None and stage not in STAGES:
+        raise ValueError(f'Unknown stage "{stage}", should be one of: {", ".join(STAGES)}')
+    if variable and stage is not None:
+        raise ValueError('Stages are not supported for the variable font.')
+    parallel = parallel and jobs != 1
     eprint(
         f'Python:    {sys.version.split()[0]}\n'
         f'fontmake:  {fontmake.__version__}\n'
@@ -400,25 +905,549 @@ def build(input_path: str, toml_path: str, output_dir: str, parallel: bool = Tru
         f'glyphsLib: {glyphsLib.__version__}\n'
         f'CPU count: {multiprocessing.cpu_count()}\n'
     )
-    with Timer(f'Parsing input file "{input_path}"...'):
-        font = Font(input_path)
-    with Timer('Generating UFO...'):
-        ufos = font.to_ufos()
-    with Timer('Generating OTF...'):
-        _build = functools.partial(_build_otf, output_dir=output_dir)
-        if parallel:
-            with multiprocessing.Pool() as p:
-                p.map(_build, ufos)
+    os.makedirs(output_dir, exist_ok=True)
+    cache = BuildCache(cache_dir or os.path.join(output_dir, '.cache'), enabled=use_cache)
+    metrics = Metrics(profiler, profile_dir or os.path.join(output_dir, 'profiles'))
+    # Output path -> input key of the finished fonts
+    outputs = {}
+    for name in ('otf', 'math', 'variable', 'math_spec', 'subset', 'woff2'):
+        metrics.add_cache(
+            f'build_{name}', lambda name=name: (cache.hits.get(name, 0), cache.misses.get(name, 0))
+        )
+    family_name, all_styles, timestamp = _read_font_info(input_path)
+    try:
+        with _source_date_epoch(timestamp):
+            _build(
+                metrics,
+                cache,
+                outputs,
+                input_path,
+                toml_path,
+                output_dir,
+                parallel,
+                use_cache,
+                incremental,
+                variable,
+                styles,
+                stage,
+                jobs,
+                glyph_names,
+                family_name,
+                all_styles,
+            )
+            if web and stage is None:
+                with metrics.stage('web', profiled=False):
+                    _build_web_fonts(list(outputs), output_dir, cache, family_name, parallel, jobs)
+        cache.record_sources()
+        cache.prune()
+    finally:
+        if outputs:
+            _write_manifest(output_dir, outputs)
+        if metrics_path:
+            metrics.write(metrics_path)
+            eprint(f'Metrics written to "{metrics_path}"')
+
+
+def _build(
+    metrics: Metrics,
+    cache: BuildCache,
+    outputs: dict[str, str],
+    input_path: str,
+    toml_path: str,
+    output_dir: str,
+    parallel: bool,
+    use_cache: bool,
+    incremental: bool,
+    variable: bool,
+    styles: list[str],
+    stage: str,
+    jobs: int,
+    glyph_names: list[str],
+    family_name: str,
+    all_styles: list[str],
+):
+    with Timer('Checking build cache...'), metrics.stage('cache'):
+        if styles is not None:
+            if unknown := [s for s in styles if s not in all_styles]:
+                raise ValueError(
+                    f'Unknown styles: {", ".join(unknown)}. Available: {", ".join(all_styles)}'
+                )
+            all_styles = [s for s in all_styles if s in styles]
+        otf_keys, math_keys = _cache_keys(
+            cache, input_path, toml_path, all_styles, glyph_names, incremental
+        )
+        output_paths = {
+            s: os.path.join(output_dir, font_file_name(family_name, s)) for s in all_styles
+        }
+        if variable:
+            variable_path = os.path.join(output_dir, font_file_name(family_name, 'VF'))
+            # The variable font depends on the same inputs as all the static fonts together.
+            variable_key = BuildCache.hash_values('variable', math_keys)
+            up_to_date = cache.get('variable', variable_key, variable_path)
+            styles = [] if up_to_date else ['VF']
+            if up_to_date:
+                outputs[variable_path] = variable_key
+            eprint(f'Up-to-date: {int(up_to_date)}/1')
+        elif stage is None:
+            styles = [
+                s for s in all_styles if not cache.get('math', math_keys[s], output_paths[s])
+            ]
+            outputs.update({output_paths[s]: math_keys[s] for s in all_styles if s not in styles})
+            eprint(f'Up-to-date: {len(all_styles) - len(styles)}/{len(all_styles)}')
         else:
-            _build_otf(ufos, output_dir)
-    with Timer('Adding MATH table...'):
-        font.add_math_table(toml_path, input_dir=output_dir)
+            # Single stages are not cached, as the inputs of the MATH stage are not known.
+            styles = all_styles
+        if stage in (None, 'math') and styles:
+            # Check the MATH table data before the expensive stages.
+            math_spec.load(toml_path, cache)
+        if stage in ('math', 'web'):
+            if missing := [p for p in output_paths.values() if not os.path.isfile(p)]:
+                raise FileNotFoundError(f'OTF not found: {", ".join(missing)}')
+    if stage == 'web':
+        font_paths = list(output_paths.values())
+        with metrics.stage('web', profiled=False):
+            _build_web_fonts(font_paths, output_dir, cache, family_name, parallel, jobs)
+        return
+    metrics.counts['styles'] = len(all_styles)
+    metrics.counts['styles_built'] = len(styles)
+    if not styles:
+        return
+    with Timer(f'Parsing input file "{input_path}"...'), metrics.stage('load'):
+        snapshot_dir = os.path.join(cache.cache_dir, 'snapshots') if use_cache else None
+        font = Font(input_path, glyph_names, processes=jobs, snapshot_dir=snapshot_dir)
+    metrics.counts['glyphs'] = len(font.font.glyphs)
+    if snapshot_dir and glyph_names is None:
+        hit = font.from_snapshot
+        metrics.add_cache('snapshot', lambda: (int(hit), int(not hit)))
+    metrics.add_cache('bounds', lambda: (font.bounds.hits, font.bounds.misses))
+    # Checked before the expensive stages, and kept for the MATH tables
+    math_data = font.math_spec(toml_path) if stage in (None, 'math') else None
+    if variable:
+        with Timer('Generating variable OTF...'), metrics.stage('variable_otf'):
+            font.build_variable_font(variable_path)
+        with Timer('Adding variable MATH table...'), metrics.stage('variable_math'):
+            font.add_variable_math_table(toml_path, variable_path, data=math_data)
+        cache.put('variable', variable_key, variable_path)
+        outputs[variable_path] = variable_key
+        eprint(f'Build cache: {cache.summary()}')
+        return
+    if stage == 'math':
+        with Timer('Adding MATH table...'), metrics.stage('math'):
+            font.add_math_table(
+                toml_path,
+                output_dir,
+                styles=styles,
+                parallel=parallel,
+                processes=jobs,
+                data=math_data,
+            )
+        return
+    math_tables = {}
+    if stage is None:
+        with Timer('Parsing MATH table data...'), metrics.stage('math_data'):
+            math_tables = font._parse_math_table(toml_path, styles, math_data)
+    if stage == 'ufo':
+        otf_styles = styles
+    else:
+        otf_styles = [s for s in styles if not cache.get('otf', otf_keys[s], output_paths[s])]
+    with Timer('Generating UFO, OTF and MATH table...'):
+        with metrics.stage('instantiator'):
+            instantiator, instances = (
+                font.instantiator(styles=otf_styles) if otf_styles else (None, [])
+            )
+        pipeline = _Pipeline(
+            family_name,
+            instantiator,
+            {i.styleName: i for i in instances},
+            math_tables,
+            font.production_names,
+            output_dir,
+            cache,
+            otf_keys,
+            os.path.join(cache.cache_dir, 'incremental') if incremental else None,
+            stage,
+            metrics.profiler,
+            metrics.profile_dir,
+        )
+        errors = {}
+        # Each worker loads the whole pipeline, so there are no more workers than styles.
+        workers = min(jobs or multiprocessing.cpu_count(), len(styles)) if parallel else 1
+        start_time = time.perf_counter()
+        with metrics.stage('pipeline', profiled=False):
+            for style, result, error in pipeline.run(styles, parallel, workers):
+                output_path = output_paths[style]
+                if stage == 'ufo':
+                    output_path = os.path.splitext(output_path)[0] + '.ufo'
+                _report(os.path.basename(output_path), error)
+                if error:
+                    errors[style] = error
+                    continue
+                metrics.add_instance(style, result)
+                if stage is None:
+                    cache.put('math', math_keys[style], output_path)
+                    outputs[output_path] = math_keys[style]
+        metrics.add_pool(
+            'pipeline',
+            time.perf_counter() - start_time,
+            workers,
+            [m['time'] for m in metrics.instances.values()],
+        )
+    eprint(f'Build cache: {cache.summary()}')
+    if errors:
+        raise BuildError(errors)
+
+
+def _build_web_fonts(
+    font_paths: list[str],
+    output_dir: str,
+    cache: BuildCache,
+    family_name: str,
+    parallel: bool = True,
+    processes: int = None,
+):
+    '''Make the web fonts of `font_paths` in `output_dir/web`, in a process pool if `parallel`.'''
+    web_dir = os.path.join(output_dir, 'web')
+    tasks = [(path, web_dir, cache, family_name) for path in font_paths]
+    errors = {}
+    with Timer('Generating web fonts...'):
+        results = map_with_errors(_web_fonts, tasks, parallel, processes)
+        for path, (counters, error) in zip(font_paths, results):
+            _report(f'{os.path.basename(path)} (web)', error)
+            if error:
+                errors[os.path.basename(path)] = error
+            else:
+                cache.add_counters(*counters)
+    if errors:
+        raise BuildError(errors)
+
+
+def _web_fonts(task: tuple) -> tuple[dict[str, int], dict[str, int]]:
+    # The counters of a worker's cache don't reach the parent process, so they are returned.
+    font_path, web_dir, cache, family_name = task
+    cache = cache.fork()
+    build_web_fonts(font_path, web_dir, Subsetter(cache), family_name)
+    return cache.hits, cache.misses
+
+
+class _Pipeline:
+    '''Build steps of each style after loading the font: generate the UFO instance, compile the
+    OTF, then add the MATH table and normalize glyph names.
+
+    The styles run independently, so that every worker process keeps busy and only a few
+    instances are in memory at once. The pipeline is pickled once to a temporary file and loaded
+    by each worker, instead of sending the instantiator (and the UFO instances) through the
+    pool's pipes; only the style names are sent.
+    '''
+
+    def __init__(
+        self,
+        family_name: str,
+        instantiator: Instantiator,
+        instances: dict[str, InstanceDescriptor],
+        math_tables: dict[str, MathTable],
+        production_names: dict[str, str],
+        output_dir: str,
+        cache: BuildCache,
+        otf_keys: dict[str, str],
+        incremental_dir: str = None,
+        stage: str = None,
+        profiler: str = None,
+        profile_dir: str = None,
+    ):
+        self.family_name = family_name
+        self.instantiator = instantiator
+        # Styles whose OTF is not cached
+        self.instances = instances
+        self.math_tables = math_tables
+        self.production_names = production_names
+        self.output_dir = output_dir
+        self.cache = cache
+        self.otf_keys = otf_keys
+        self.incremental_dir = incremental_dir
+        # Last stage to run ('ufo' or 'otf'), or `None` to add the MATH table as well
+        self.stage = stage
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+
+    def run(self, styles: list[str], parallel: bool = True, processes: int = None):
+        '''Build `styles`, and yield `(style, metrics, error)` as the fonts are finished, in a
+        deterministic order. `error` is `None`, or the traceback if the style failed.
+        '''
+        # Start with the styles to compile, which take much longer than adding MATH.
+        styles = sorted(styles, key=lambda s: s not in self.instances)
+        if not parallel:
+            results = map_with_errors(self.build_style, styles, parallel=False)
+            yield from ((s, *result) for s, result in zip(styles, results))
+            return
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipeline_path = os.path.join(tmp_dir, 'pipeline.pickle')
+            with open(pipeline_path, 'wb') as f, _gc_paused():
+                pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+            results = map_with_errors(
+                _build_style,
+                styles,
+                processes=processes,
+                initializer=_init_pipeline_worker,
+                initargs=(pipeline_path,),
+            )
+            yield from ((s, *result) for s, result in zip(styles, results))
+
+    def build_style(self, style: str) -> dict[str]:
+        '''Build `style`, and return its metrics (see `InstanceTimer.result()`).'''
+        with profile(self.profiler, profile_path(self.profiler, self.profile_dir, style)):
+            return self._build_style(style)
 
+    def _build_style(self, style: str) -> dict[str]:
+        timer = InstanceTimer()
+        output_path = os.path.join(self.output_dir, font_file_name(self.family_name, style))
+        glyphs = None
+        if style in self.instances:
+            ufo = Font._generate_instance(self.instantiator, self.instances[style])
+            glyphs = len(ufo)
+            timer.step('ufo')
+            if self.stage == 'ufo':
+                ufo.save(os.path.splitext(output_path)[0] + '.ufo', overwrite=True)
+                timer.step('save_ufo')
+                return timer.result(glyphs=glyphs)
+            _build_otf(ufo, self.output_dir, self.incremental_dir)
+            self.cache.put('otf', self.otf_keys[style], output_path)
+            timer.step('otf')
+        if self.stage != 'otf':
+            Font._postprocess(
+                self.math_tables[style], self.production_names, output_path, output_path
+            )
+            timer.step('math')
+        return timer.result(glyphs=glyphs)
+
+
+# The pipeline of each worker process of `_Pipeline.run()`
+_worker_pipeline: _Pipeline = None
+
+
+def _init_pipeline_worker(pipeline_path: str):
+    global _worker_pipeline
+    with open(pipeline_path, 'rb') as f, _gc_paused():
+        _worker_pipeline = pickle.load(f)
+
+
+def _build_style(style: str) -> dict[str]:
+    return _worker_pipeline.build_style(style)
+
+
+def _postprocess(task: tuple):
+    Font._postprocess(*task)
+
+
+def _report(font_file_name: str, error: str = None):
+    if error:
+        eprint(f'=> {font_file_name} failed:\n{error}')
+    else:
+        eprint(f'=> {font_file_name}')
+
+
+def _read_font_info(input_path: str) -> tuple[str, list[str], int]:
+    '''Return the family name, the active instance names and the date of the font (as a Unix
+    timestamp), without loading the whole font if it's a `.glyphspackage`.
+    '''
+    if not os.path.isdir(input_path):
+        font = glyphsLib.load(input_path)
+        styles = [i.name for i in font.instances if i.active]
+        # glyphsLib gives a naive datetime, which `timestamp()` would take as local time.
+        date = font.date.replace(tzinfo=datetime.timezone.utc)
+        return font.familyName, styles, int(date.timestamp())
+    with open(os.path.join(input_path, 'fontinfo.plist'), encoding='utf-8') as f:
+        info = openstep_plist.load(f, use_numbers=True)
+    styles = [i['name'] for i in info['instances'] if i.get('exports', 1)]
+    date = datetime.datetime.strptime(info['date'], '%Y-%m-%d %H:%M:%S %z')
+    return info['familyName'], styles, int(date.timestamp())
+
+
+@contextlib.contextmanager
+def _source_date_epoch(timestamp: int):
+    '''Set `SOURCE_DATE_EPOCH` to `timestamp` (unless it's already set) temporarily.
+
+    fontTools and ufo2ft use it instead of the current time for the `head` created and modified
+    dates, so that building the same sources again gives the same bytes. The worker processes
+    inherit it.
+    '''
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        yield
+        return
+    os.environ['SOURCE_DATE_EPOCH'] = str(timestamp)
+    try:
+        yield
+    finally:
+        del os.environ['SOURCE_DATE_EPOCH']
+
+
+def _write_manifest(output_dir: str, outputs: dict[str, str]):
+    '''Add the fonts `outputs` (output path -> cache key of all the inputs) with their hashes to
+    `output_dir/manifest.json`. As the builds are reproducible, a font with the same input key
+    has the same hash, so that downstream jobs can skip rebuilding or uploading it.
+    '''
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    for path, key in outputs.items():
+        manifest[os.path.relpath(path, output_dir)] = {
+            'input': key,
+            'sha256': BuildCache.hash_file(path),
+        }
+    BuildCache.atomic_write(
+        manifest_path, json.dumps(manifest, indent=2, sort_keys=True).encode() + b'\n'
+    )
+
+
+def _script_hashes() -> dict[str, str]:
+    '''Return the hashes of `BUILD_SCRIPTS`, keyed by their paths.'''
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return BuildCache.source_hashes(*(os.path.join(script_dir, f) for f in BUILD_SCRIPTS))
 
-def _build_otf(ufo, output_dir):
+
+def _cache_keys(
+    cache: BuildCache,
+    input_path: str,
+    toml_path: str,
+    styles: list[str],
+    glyph_names: list[str] = None,
+    incremental: bool = False,
+) -> tuple[dict[str, str], dict[str, str]]:
+    '''Return the cache keys of the OTF (before adding MATH table) and the final font of each
+    style. The keys depend on every source file, the build scripts, the tool versions, the
+    glyph subset, whether the OTFs are compiled incrementally (which gives different,
+    unsubroutinized CFF tables) and `SOURCE_DATE_EPOCH` (the `head` dates, see
+    `_source_date_epoch()`).
+    '''
+    source_hashes = BuildCache.source_hashes(input_path, toml_path)
+    if changed := cache.changed_sources(source_hashes):
+        eprint(f'Changed source files: {len(changed)}')
+    script_hashes = _script_hashes()
+    versions = [fontmake.__version__, fontTools.__version__, glyphsLib.__version__]
+    glyph_hashes = {
+        os.path.relpath(path, input_path): value
+        for path, value in source_hashes.items() if path != toml_path
+    }
+    scripts_key = BuildCache.hash_values(
+        versions, sorted(script_hashes.values()), os.environ.get('SOURCE_DATE_EPOCH')
+    )
+    if glyph_names is not None:
+        scripts_key = BuildCache.hash_values(scripts_key, sorted(glyph_names))
+    if incremental:
+        scripts_key = BuildCache.hash_values(scripts_key, 'incremental')
+    otf_keys = {s: BuildCache.hash_values(scripts_key, glyph_hashes, s) for s in styles}
+    math_keys = {
+        s: BuildCache.hash_values(otf_keys[s], source_hashes[toml_path]) for s in styles
+    }
+    return otf_keys, math_keys
+
+
+def _build_otf(ufo, output_dir, incremental_dir: str = None):
     ufos = ufo if isinstance(ufo, list) else [ufo]
-    FontProject().save_otfs(ufos, output_dir=output_dir, optimize_cff=2)
+    if not incremental_dir:
+        FontProject().save_otfs(ufos, output_dir=output_dir, optimize_cff=2)
+        return
+    for ufo in ufos:
+        compiler = IncrementalCompiler(ufo, incremental_dir)
+        output_path = os.path.join(
+            output_dir, font_file_name(ufo.info.familyName, ufo.info.styleName)
+        )
+        if (changed := compiler.changed_glyphs()) is None:
+            FontProject().save_otfs([ufo], output_path=output_path, optimize_cff=2)
+        else:
+            eprint(f'{os.path.basename(output_path)}: {len(changed)} glyph(s) changed')
+            compiler.splice(changed, output_path)
+        compiler.save_state(output_path)
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description='Build Fira Math.')
+    parser.add_argument(
+        '--input', default='src/FiraMath.glyphspackage', help='Glyphs source (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--toml', default='src/FiraMath.toml', help='MATH table data (default: %(default)s)'
+    )
+    parser.add_argument(
+        '-o', '--output-dir', default='build/', help='output directory (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--styles',
+        type=_comma_list,
+        help='comma-separated styles to build, e.g. "Regular,Bold" (default: all)',
+    )
+    parser.add_argument(
+        '--stage',
+        choices=STAGES,
+        help='only generate the UFO instances, only compile the OTFs, only add the MATH table '
+        'to the existing OTFs, or only make the web fonts of the existing OTFs (default: all '
+        'the stages, the web fonts only with --web)',
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, help='number of worker processes (default: the CPU count)'
+    )
+    parser.add_argument(
+        '--glyphs',
+        type=_comma_list,
+        help='comma-separated glyphs to build (with the glyphs referenced by them), for quick '
+        'proofs',
+    )
+    parser.add_argument(
+        '--variable',
+        action='store_true',
+        help='build a CFF2 variable font instead of the static fonts',
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='only recompile the glyphs changed since the previous build',
+    )
+    parser.add_argument(
+        '--web',
+        action='store_true',
+        help='also make WOFF2 fonts and Unicode-range subsets in OUTPUT_DIR/web/',
+    )
+    parser.add_argument('--no-cache', action='store_true', help='disable the build cache')
+    parser.add_argument(
+        '--metrics', help='write the timings, memory usage and cache hit rates as JSON to this file'
+    )
+    parser.add_argument(
+        '--profile',
+        choices=PROFILERS,
+        help='profile each stage and style, into OUTPUT_DIR/profiles/ by default',
+    )
+    parser.add_argument('--profile-dir', help='directory of the profiles')
+    args = parser.parse_args(argv)
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.variable and (args.stage or args.styles):
+        parser.error('--variable cannot be used with --stage or --styles')
+    try:
+        build(
+            args.input,
+            toml_path=args.toml,
+            output_dir=args.output_dir,
+            use_cache=not args.no_cache,
+            incremental=args.incremental,
+            variable=args.variable,
+            styles=args.styles,
+            stage=args.stage,
+            jobs=args.jobs,
+            glyph_names=args.glyphs,
+            web=args.web,
+            metrics_path=args.metrics,
+            profiler=args.profile,
+            profile_dir=args.profile_dir,
+        )
+    except BuildError as e:
+        eprint(f'Error: {e}')
+        sys.exit(1)
+
+
+def _comma_list(s: str) -> list[str]:
+    return [item.strip() for item in s.split(',') if item.strip()]
 
 
 if __name__ == '__main__':
-    build('src/FiraMath.glyphspackage', toml_path='src/FiraMath.toml', output_dir='build/')
+    main()
@@ -0,0 +1,185 @@
+'''Content-addressed build cache.
+
+Every cached artifact is stored under the hash of all the inputs that produced it, so that a
+cache entry can never be stale: changing any input gives a different key, and old entries are
+simply not looked up anymore. They are removed by `BuildCache.prune()`, least recently used
+first.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+
+class BuildCache:
+
+    # Size of the artifacts kept by `prune()`, about 10 full builds with web fonts
+    MAX_SIZE = 512 * 1024 * 1024
+
+    def __init__(self, cache_dir: str, enabled: bool = True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        # The artifacts used after this time are kept by `prune()`. File system timestamps can
+        # lag a little behind `time.time()`.
+        self._start_time = time.time() - 2
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+        # Hashes of the source files, recorded when the build succeeded
+        self._source_hashes: dict[str, str] = None
+        if self.enabled:
+            os.makedirs(self._objects_dir, exist_ok=True)
+
+    @property
+    def _objects_dir(self) -> str:
+        return os.path.join(self.cache_dir, 'objects')
+
+    @property
+    def _manifest_path(self) -> str:
+        return os.path.join(self.cache_dir, 'sources.json')
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @staticmethod
+    def hash_values(*values) -> str:
+        '''Return the hash of JSON-serializable `values`.'''
+        s = json.dumps(values, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(s.encode()).hexdigest()
+
+    @staticmethod
+    def source_hashes(*paths: str) -> dict[str, str]:
+        '''Return the hashes of all files in `paths`, which can be files or directories (e.g.
+        `.glyphspackage`). The keys are the file paths.
+        '''
+        result = {}
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for file in sorted(files):
+                        file_path = os.path.join(root, file)
+                        result[file_path] = BuildCache.hash_file(file_path)
+            else:
+                result[path] = BuildCache.hash_file(path)
+        return result
+
+    def changed_sources(self, hashes: dict[str, str]) -> list[str]:
+        '''Compare `hashes` with the ones recorded by the last successful build, and return the
+        paths of the added, removed and modified files. The new hashes are recorded by
+        `record_sources()`, once the build succeeded.
+        '''
+        old_hashes = {}
+        if self.enabled and os.path.isfile(self._manifest_path):
+            with open(self._manifest_path, encoding='utf-8') as f:
+                old_hashes = json.load(f)
+        self._source_hashes = hashes
+        return sorted(
+            path for path in hashes.keys() | old_hashes.keys()
+            if hashes.get(path) != old_hashes.get(path)
+        )
+
+    def record_sources(self):
+        '''Record the hashes of the last `changed_sources()` call, for the next build.'''
+        if self.enabled and self._source_hashes is not None:
+            self.atomic_write(
+                self._manifest_path, json.dumps(self._source_hashes, indent=1).encode()
+            )
+
+    def fork(self) -> 'BuildCache':
+        '''Return a cache of the same directory with its own counters, e.g. for a worker
+        process. Its counters are added back to this cache with `add_counters()`.
+        '''
+        return BuildCache(self.cache_dir, self.enabled)
+
+    def add_counters(self, hits: dict[str, int], misses: dict[str, int]):
+        '''Add the `hits` and `misses` of another cache (see `fork()`) to the counters.'''
+        for counters, other in ((self.hits, hits), (self.misses, misses)):
+            for stage, count in other.items():
+                counters[stage] = counters.get(stage, 0) + count
+
+    def _object_path(self, stage: str, key: str) -> str:
+        return os.path.join(self._objects_dir, stage, key[:2], key)
+
+    def get(self, stage: str, key: str, output_path: str) -> bool:
+        '''Copy the artifact of `stage` with `key` to `output_path`. Return `False` if there
+        is no such artifact.
+        '''
+        object_path = self._object_path(stage, key)
+        if self.enabled and os.path.isfile(object_path):
+            shutil.copyfile(object_path, output_path)
+            # The modification time is the last use, for `prune()`.
+            os.utime(object_path)
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            return True
+        self.misses[stage] = self.misses.get(stage, 0) + 1
+        return False
+
+    def put(self, stage: str, key: str, input_path: str):
+        '''Store the file `input_path` as the artifact of `stage` with `key`.'''
+        if not self.enabled:
+            return
+        object_path = self._object_path(stage, key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        with open(input_path, 'rb') as f:
+            self.atomic_write(object_path, f.read())
+
+    def read(self, stage: str, key: str) -> bytes:
+        '''Return the content of the artifact of `stage` with `key`, or `None` if there is no
+        such artifact.
+        '''
+        object_path = self._object_path(stage, key)
+        if self.enabled and os.path.isfile(object_path):
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            os.utime(object_path)
+            with open(object_path, 'rb') as f:
+                return f.read()
+        self.misses[stage] = self.misses.get(stage, 0) + 1
+        return None
+
+    def write(self, stage: str, key: str, data: bytes):
+        '''Store `data` as the artifact of `stage` with `key`.'''
+        if not self.enabled:
+            return
+        object_path = self._object_path(stage, key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        self.atomic_write(object_path, data)
+
+    def prune(self, max_size: int = None):
+        '''Remove the least recently used artifacts until they take at most `max_size` bytes
+        (default to `MAX_SIZE`). The artifacts used since this cache was created are kept.
+        '''
+        if not self.enabled:
+            return
+        max_size = self.MAX_SIZE if max_size is None else max_size
+        entries = []
+        for root, _, files in os.walk(self._objects_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(file_size for _, file_size, _ in entries)
+        for mtime, file_size, path in sorted(entries):
+            if size <= max_size or mtime >= self._start_time:
+                break
+            os.remove(path)
+            size -= file_size
+
+    @staticmethod
+    def atomic_write(path: str, data: bytes):
+        '''Write `data` to the file `path`. The data goes to a temporary file first, so that
+        concurrent or interrupted builds never leave a truncated file behind.
+        '''
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def summary(self) -> str:
+        return ', '.join(
+            f'{stage}: {self.hits.get(stage, 0)} hit(s), {self.misses.get(stage, 0)} miss(es)'
+            for stage in sorted(self.hits.keys() | self.misses.keys())
+        ) or 'empty'
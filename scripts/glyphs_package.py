@@ -0,0 +1,163 @@
+'''Load `.glyphspackage` directories.
+
+This is a replacement of `glyphsLib.load()` for packages: the `.glyph` files are parsed in a
+process pool, and optionally only a subset of glyphs (with the glyphs they reference as
+components) is loaded.
+'''
+
+import concurrent.futures
+import os
+import re
+
+import openstep_plist
+from glyphsLib.classes import GSFont
+from glyphsLib.parser import Parser
+
+# Number of `.glyph` files parsed by each task of the process pool.
+_CHUNK_SIZE = 200
+
+# Key of the variants and assemblies in the userData of the MATH plugin of Glyphs
+MATH_VARIANTS_KEY = 'com.nagwa.MATHPlugin.variants'
+
+# The glyph name line of a `.glyph` file
+GLYPH_NAME_RE = re.compile(r'^glyphname = "?(.+?)"?;$', re.MULTILINE)
+
+_WORD_RE = re.compile(r'[\w.\-]+')
+
+
+def load(path: str, glyph_names: list[str] = None, processes: int = None) -> GSFont:
+    '''Load the `.glyphspackage` directory `path` into a `GSFont`.
+
+    If `glyph_names` is specified, only these glyphs and the glyphs referenced by their
+    components, MATH variants or the feature code are loaded. The `.glyph` files are parsed by
+    `processes` processes (default to the CPU count); there is no process pool when it's 1.
+    '''
+    data = _load_info(path)
+    glyph_paths = _glyph_paths(path)
+    if glyph_names is None:
+        glyphs = _parse_glyphs(list(glyph_paths.values()), processes)
+    else:
+        glyph_names = list(glyph_names) + sorted(_feature_refs(data) & glyph_paths.keys())
+        glyphs = _parse_glyph_closure(glyph_paths, glyph_names, processes)
+    order = {name: i for i, name in enumerate(data.pop('_glyphOrder'))}
+
+    def sort_key(glyph):
+        name = glyph['glyphname']
+        return (0, order[name]) if name in order else (1, name)
+
+    data['glyphs'] = sorted(glyphs, key=sort_key)
+    font = GSFont()
+    Parser(current_type=GSFont).parse_into_object(font, data)
+    return font
+
+
+def _load_info(path: str) -> dict[str]:
+    '''Load `fontinfo.plist`, `order.plist` and `UIState.plist`, the same as
+    `glyphsLib.parser.load_glyphspackage()`.
+    '''
+    with open(os.path.join(path, 'fontinfo.plist'), encoding='utf-8') as f:
+        data = openstep_plist.load(f, use_numbers=True)
+    data['_glyphOrder'] = []
+    if os.path.isfile(order_path := os.path.join(path, 'order.plist')):
+        with open(order_path, encoding='utf-8') as f:
+            data['_glyphOrder'] = openstep_plist.load(f)
+    if os.path.isfile(ui_state_path := os.path.join(path, 'UIState.plist')):
+        with open(ui_state_path, encoding='utf-8') as f:
+            ui_state = openstep_plist.load(f, use_numbers=True)
+        if 'displayStrings' in ui_state and 'DisplayStrings' not in ui_state:
+            ui_state['DisplayStrings'] = ui_state.pop('displayStrings')
+        data.update(ui_state)
+    return data
+
+
+def _glyph_paths(path: str) -> dict[str, str]:
+    '''Return the mapping from glyph names to `.glyph` file paths. Only the beginning of each
+    file is read.
+    '''
+    glyphs_dir = os.path.join(path, 'glyphs')
+    result = {}
+    for file_name in sorted(os.listdir(glyphs_dir)):
+        if not file_name.endswith('.glyph'):
+            continue
+        glyph_path = os.path.join(glyphs_dir, file_name)
+        with open(glyph_path, encoding='utf-8') as f:
+            head = f.read(512)
+        if match := GLYPH_NAME_RE.search(head):
+            name = match.group(1)
+        else:
+            name = _parse_glyph_file(glyph_path)['glyphname']
+        result[name] = glyph_path
+    return result
+
+
+def _parse_glyph_file(path: str) -> dict[str]:
+    with open(path, encoding='utf-8') as f:
+        return openstep_plist.load(f, use_numbers=True)
+
+
+def _parse_glyph_files(paths: list[str]) -> list[dict[str]]:
+    return [_parse_glyph_file(path) for path in paths]
+
+
+def _parse_glyphs(paths: list[str], processes: int = None) -> list[dict[str]]:
+    processes = processes or os.cpu_count()
+    if processes == 1 or len(paths) <= _CHUNK_SIZE:
+        return _parse_glyph_files(paths)
+    chunks = [paths[i:i + _CHUNK_SIZE] for i in range(0, len(paths), _CHUNK_SIZE)]
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        return [glyph for result in executor.map(_parse_glyph_files, chunks) for glyph in result]
+
+
+def _parse_glyph_closure(
+    glyph_paths: dict[str, str],
+    glyph_names: list[str],
+    processes: int = None,
+) -> list[dict[str]]:
+    '''Parse `glyph_names` and (recursively) the glyphs referenced by their components.'''
+    if missing := [name for name in glyph_names if name not in glyph_paths]:
+        raise ValueError(f'Glyphs not found: {", ".join(missing)}')
+    result = {}
+    names = set(glyph_names)
+    while names:
+        for glyph in _parse_glyphs([glyph_paths[name] for name in names], processes):
+            result[glyph['glyphname']] = glyph
+        names = {
+            ref for glyph in result.values() for ref in _component_refs(glyph)
+            if ref not in result and ref in glyph_paths
+        }
+    return list(result.values())
+
+
+def _feature_refs(data: dict[str]) -> set[str]:
+    '''Return the words of the feature code, which include the glyphs it references.'''
+    return {
+        word for key in ('classes', 'featurePrefixes', 'features')
+        for feature in data.get(key, []) for word in _WORD_RE.findall(feature.get('code', ''))
+    }
+
+
+def _component_refs(glyph: dict[str]) -> set[str]:
+    '''Return the glyphs referenced by components, and by the MATH variants of the glyph (which
+    must be in the font for ufo2ft to compile the MATH table).
+    '''
+    refs = _math_variant_refs(glyph)
+    for layer in glyph.get('layers', []):
+        for shape in layer.get('shapes', []):
+            if 'ref' in shape:
+                refs.add(shape['ref'])
+        # Glyphs 2 format
+        for component in layer.get('components', []):
+            refs.add(component['name'])
+        refs |= _math_variant_refs(layer)
+    return refs
+
+
+def _math_variant_refs(data: dict[str]) -> set[str]:
+    variants = data.get('userData', {}).get(MATH_VARIANTS_KEY, {})
+    refs = set()
+    for key in ('hVariants', 'vVariants'):
+        refs.update(variants.get(key, []))
+    for key in ('hAssembly', 'vAssembly'):
+        # Parts are `(glyph name, is extender, start connector, end connector)`
+        refs.update(part[0] for part in variants.get(key, []))
+    return refs
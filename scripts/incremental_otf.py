@@ -0,0 +1,168 @@
+'''Incremental OTF compilation.
+
+Instead of compiling the whole UFO instance again, recompile the CFF charstrings and metrics of
+the glyphs whose outlines changed since the last build, and splice them into the previous OTF.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+
+from fontTools.misc.roundTools import otRound
+from fontTools.pens.recordingPen import DecomposingRecordingPen
+from fontTools.pens.t2CharStringPen import T2CharStringPen
+from fontTools.ttLib import TTFont
+from fontTools.ufoLib import fontInfoAttributesVersion3
+from ufo2ft.fontInfoData import getAttrWithFallback
+from ufo2ft.preProcessor import OTFPreProcessor
+import ufoLib2
+
+
+class IncrementalCompiler:
+
+    # Fall back to a full compilation if too many glyphs changed, as splicing gives up the
+    # subroutinization of these glyphs.
+    MAX_CHANGED_RATIO = 0.25
+
+    def __init__(self, ufo, state_dir: str):
+        self.ufo = ufo
+        name = f'{ufo.info.familyName}-{ufo.info.styleName}'.replace(' ', '')
+        self.otf_path = os.path.join(state_dir, f'{name}.otf')
+        self.digest_path = os.path.join(state_dir, f'{name}.json')
+        self._digests = None
+
+    @property
+    def digests(self) -> dict[str]:
+        if self._digests is None:
+            self._digests = {
+                'font': self._font_digest(),
+                'glyphs': {g.name: self._outline_digest(g) for g in self.ufo},
+            }
+        return self._digests
+
+    def changed_glyphs(self) -> list[str]:
+        '''Return the names of the glyphs whose outlines or advance widths changed since the last
+        build, or `None` if the previous OTF can't be reused.
+        '''
+        # Compilation may modify the UFO in place, so the digests must be computed beforehand.
+        digests = self.digests
+        if not (os.path.isfile(self.otf_path) and os.path.isfile(self.digest_path)):
+            return None
+        with open(self.digest_path, encoding='utf-8') as f:
+            old_digests = json.load(f)
+        glyphs, old_glyphs = digests['glyphs'], old_digests['glyphs']
+        if digests['font'] != old_digests['font'] or glyphs.keys() != old_glyphs.keys():
+            return None
+        changed = [name for name, value in glyphs.items() if value != old_glyphs[name]]
+        if len(changed) > self.MAX_CHANGED_RATIO * len(glyphs):
+            return None
+        return changed
+
+    def splice(self, glyph_names: list[str], output_path: str):
+        '''Compile `glyph_names` and write the previous OTF with these glyphs replaced to
+        `output_path`.
+        '''
+        with TTFont(self.otf_path) as tt_font:
+            glyph_names = [g for g in glyph_names if g in tt_font.getReverseGlyphMap()]
+            if glyph_names:
+                self._splice(tt_font, glyph_names)
+            tt_font.save(output_path)
+
+    def _splice(self, tt_font: TTFont, glyph_names: list[str]):
+        glyph_set = self._preprocessed_glyphs(glyph_names)
+        cff = tt_font['CFF '].cff
+        top_dict = cff[cff.fontNames[0]]
+        char_strings = top_dict.CharStrings
+        private = top_dict.Private
+        hmtx = tt_font['hmtx']
+        widths_changed = False
+        for name in glyph_names:
+            glyph = glyph_set[name]
+            # Same as `ufo2ft.outlineCompiler.OutlineOTFCompiler.getCharStringForGlyph()`
+            width = otRound(glyph.width)
+            if width == private.defaultWidthX:
+                cs_width = None
+            else:
+                cs_width = width - private.nominalWidthX
+            pen = T2CharStringPen(cs_width, glyph_set, roundTolerance=0.5)
+            glyph.draw(pen)
+            char_string = pen.getCharString(private, top_dict.GlobalSubrs, optimize=True)
+            char_strings[name] = char_string
+            bounds = char_string.calcBounds(char_strings)
+            widths_changed |= hmtx[name][0] != width
+            hmtx[name] = (width, otRound(bounds[0]) if bounds else 0)
+        if widths_changed:
+            tt_font['OS/2'].xAvgCharWidth = self._avg_char_width()
+        # `head`, `hhea` and the CFF `FontBBox` are recalculated while saving.
+
+    def _avg_char_width(self) -> int:
+        '''Return `xAvgCharWidth` as ufo2ft computes it: the average of the non-zero advance
+        widths of all the exported glyphs (with the `.notdef` it adds if missing), before the
+        "Remove Glyphs" subset of fontmake.
+        '''
+        skip_export_glyphs = set(self.ufo.lib.get('public.skipExportGlyphs', ()))
+        widths = [otRound(g.width) for g in self.ufo if g.name not in skip_export_glyphs]
+        if '.notdef' not in self.ufo:
+            widths.append(otRound(getAttrWithFallback(self.ufo.info, 'unitsPerEm') * 0.5))
+        widths = [w for w in widths if w > 0]
+        return otRound(sum(widths) / len(widths)) if widths else 0
+
+    def _preprocessed_glyphs(self, glyph_names: list[str]) -> dict:
+        '''Run the same preprocessing as fontmake (decomposition, overlap removal, filters from
+        the UFO lib) on `glyph_names` and the glyphs they reference.
+        '''
+        names = set()
+        stack = list(glyph_names)
+        while stack:
+            name = stack.pop()
+            if name in names or name not in self.ufo:
+                continue
+            names.add(name)
+            stack.extend(c.baseGlyph for c in self.ufo[name].components)
+        subset_ufo = ufoLib2.Font()
+        subset_ufo.info = self.ufo.info
+        subset_ufo.lib.update(self.ufo.lib)
+        for name in names:
+            subset_ufo.layers.defaultLayer.insertGlyph(self.ufo[name])
+        return OTFPreProcessor(
+            subset_ufo,
+            inplace=True,
+            removeOverlaps=True,
+            skipExportGlyphs=subset_ufo.lib.get('public.skipExportGlyphs', []),
+        ).process()
+
+    def save_state(self, otf_path: str):
+        '''Keep `otf_path` and the glyph digests for the next build.'''
+        os.makedirs(os.path.dirname(self.otf_path), exist_ok=True)
+        if os.path.abspath(otf_path) != os.path.abspath(self.otf_path):
+            shutil.copyfile(otf_path, self.otf_path)
+        with open(self.digest_path, 'w', encoding='utf-8') as f:
+            json.dump(self.digests, f)
+
+    def _font_digest(self) -> str:
+        '''Return the digest of everything except glyph outlines and advance widths.'''
+        info = {attr: getattr(self.ufo.info, attr) for attr in fontInfoAttributesVersion3}
+        glyphs = {
+            g.name: (g.unicodes, [(a.name, a.x, a.y) for a in g.anchors], g.lib)
+            for g in self.ufo
+        }
+        data = (
+            info,
+            self.ufo.features.text,
+            dict(self.ufo.groups),
+            sorted(self.ufo.kerning.items()),
+            self.ufo.lib,
+            glyphs,
+        )
+        return _digest(data)
+
+    def _outline_digest(self, glyph) -> str:
+        pen = DecomposingRecordingPen(self.ufo, skipMissingComponents=True)
+        glyph.draw(pen)
+        return _digest((glyph.width, pen.value))
+
+
+def _digest(data) -> str:
+    s = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha256(s.encode()).hexdigest()
@@ -0,0 +1,204 @@
+'''Compiled MATH table data.
+
+`FiraMath.toml` is parsed, checked against the expected schema and its `?`/`#` glyph name DSL is
+expanded (see the comments of the file) once. The result is cached as JSON under the hash of the
+file, so that later builds only decode the JSON.
+'''
+
+import hashlib
+import json
+
+from fontTools.ttLib.tables import otTables
+
+from build_cache import BuildCache
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import toml as tomllib
+
+# Change this when the compiled data changes, to invalidate the cached data.
+_SPEC_VERSION = 1
+
+_MATH_CONSTANTS = [c.name for c in otTables.MathConstants.converters]
+
+# Hash of the compiled data -> compiled data as JSON, shared by all the loads in a process
+_compiled: dict[str, bytes] = {}
+
+
+class MathSpecError(ValueError):
+
+    def __init__(self, path: str, errors: list[str]):
+        super().__init__(f'{path}:\n' + '\n'.join(f'  {e}' for e in errors))
+        self.errors = errors
+
+
+def load(path: str, cache: BuildCache = None) -> dict[str]:
+    '''Return the MATH table data of the TOML file `path`, with the glyph names expanded. The
+    data is a new object, which can be modified by the caller.
+
+    The compiled data is stored in `cache` if specified. Raise `MathSpecError` if the data
+    doesn't match the schema.
+    '''
+    with open(path, 'rb') as f:
+        content = f.read()
+    key = BuildCache.hash_values('math_spec', _SPEC_VERSION, hashlib.sha256(content).hexdigest())
+    compiled = _compiled.get(key)
+    if compiled is None and cache:
+        compiled = cache.read('math_spec', key)
+    if compiled is None:
+        data = tomllib.loads(content.decode('utf-8'))
+        if errors := validate(data):
+            raise MathSpecError(path, errors)
+        compiled = json.dumps(_expand(data)).encode()
+        if cache:
+            cache.write('math_spec', key, compiled)
+    _compiled[key] = compiled
+    return json.loads(compiled)
+
+
+def validate(data: dict[str]) -> list[str]:
+    '''Return the errors of the MATH table data `data`, before expansion.'''
+    errors = []
+    master_counts = set()
+
+    def check_values(values, path: str):
+        if not _is_list(values, int) or not values:
+            errors.append(f'{path}: expected a non-empty list of integers, got {values!r}.')
+        else:
+            master_counts.add(len(values))
+
+    for key in ('MathConstants', 'MathGlyphInfo', 'MathVariants'):
+        if not isinstance(data.get(key), dict):
+            errors.append(f'{key}: missing table.')
+    if errors:
+        return errors
+    constants = data['MathConstants']
+    for name in constants.keys() - _MATH_CONSTANTS:
+        errors.append(f'MathConstants/{name}: unknown constant.')
+    for name in _MATH_CONSTANTS:
+        if name not in constants:
+            errors.append(f'MathConstants/{name}: missing.')
+        else:
+            check_values(constants[name], f'MathConstants/{name}')
+    glyph_info = data['MathGlyphInfo']
+    for name in ('ItalicCorrection', 'TopAccent'):
+        if not isinstance(glyph_info.get(name, {}), dict):
+            errors.append(f'MathGlyphInfo/{name}: expected a table.')
+            continue
+        for glyph, values in glyph_info.get(name, {}).items():
+            check_values(values, f'MathGlyphInfo/{name}/{glyph}')
+    if not _is_list(glyph_info.get('ExtendedShapes', []), str):
+        errors.append('MathGlyphInfo/ExtendedShapes: expected a list of glyph names.')
+    variants = data['MathVariants']
+    check_values(variants.get('MinConnectorOverlap'), 'MathVariants/MinConnectorOverlap')
+    for key in ('HorizontalVariants', 'VerticalVariants'):
+        for glyph, value in variants.get(key, {}).items():
+            if not isinstance(value, str) and not _is_list(value, str):
+                errors.append(
+                    f'MathVariants/{key}/{glyph}: expected a glyph name pattern or a list of '
+                    f'glyph names, got {value!r}.'
+                )
+    for key in ('HorizontalComponents', 'VerticalComponents'):
+        for glyph, component in variants.get(key, {}).items():
+            path = f'MathVariants/{key}/{glyph}'
+            if not isinstance(component, dict):
+                errors.append(f'{path}: expected a table.')
+                continue
+            if not isinstance(component.get('italicsCorrection'), int):
+                errors.append(f'{path}/italicsCorrection: expected an integer.')
+            parts = component.get('parts')
+            if not isinstance(parts, list) or not parts:
+                errors.append(f'{path}/parts: expected a non-empty list.')
+                continue
+            for i, part in enumerate(parts):
+                if not isinstance(part, dict) or not isinstance(part.get('name'), str) \
+                        or not isinstance(part.get('isExtender'), bool):
+                    errors.append(
+                        f'{path}/parts/{i}: expected {{ name = "...", isExtender = true/false }}, '
+                        f'got {part!r}.'
+                    )
+    if len(master_counts) > 1:
+        errors.append(f'Inconsistent number of master values: {sorted(master_counts)}.')
+    return errors
+
+
+def _is_list(value, item_type: type) -> bool:
+    return isinstance(value, list) and all(
+        isinstance(i, item_type) and not isinstance(i, bool) for i in value
+    )
+
+
+def _expand(data: dict[str]) -> dict[str]:
+    glyph_info = data['MathGlyphInfo']
+    glyph_info.setdefault('ItalicCorrection', {})
+    glyph_info.setdefault('TopAccent', {})
+    glyph_info['ExtendedShapes'] = expand_glyph_names(glyph_info.get('ExtendedShapes', []))
+    variants = data['MathVariants']
+    for key in ('HorizontalVariants', 'VerticalVariants'):
+        variants[key] = {
+            glyph: expand_glyph_names([value] if isinstance(value, str) else value)
+            for glyph, value in variants.get(key, {}).items()
+        }
+    for key in ('HorizontalComponents', 'VerticalComponents'):
+        variants.setdefault(key, {})
+    return data
+
+
+def expand_glyph_names(names: list[str]) -> list[str]:
+    '''Expand the glyph name patterns `names`, e.g. `"a?.size#2"` -> `"a"`, `"a.size01"`,
+    `"a.size02"`.
+    '''
+    result = []
+    for s in names:
+        result.extend(_string_expand(s))
+    return result
+
+
+def _string_expand(s: str) -> list[str]:
+    try:
+        (base, suffix) = s.split('?')
+        return [base] + [base + i for i in _string_expand_hash(suffix)]
+    except ValueError:
+        return _string_expand_hash(s)
+
+
+def _string_expand_hash(s: str) -> list[str]:
+    try:
+        (base, num) = s.split('#')
+        return [f'{base}{i:02}' for i in range(1, int(num) + 1)]
+    except ValueError:
+        return [s]
+
+
+def glyph_references(data: dict[str]):
+    '''Yield the glyphs referenced in the expanded MATH table data, with where they are
+    referenced.
+    '''
+    glyph_info = data['MathGlyphInfo']
+    for name in ('ItalicCorrection', 'TopAccent'):
+        for glyph in glyph_info[name]:
+            yield glyph, f'MathGlyphInfo/{name}'
+    for glyph in glyph_info['ExtendedShapes']:
+        yield glyph, 'MathGlyphInfo/ExtendedShapes'
+    variants = data['MathVariants']
+    for key in ('HorizontalVariants', 'VerticalVariants'):
+        for glyph, glyph_variants in variants[key].items():
+            yield glyph, f'MathVariants/{key}'
+            for g in glyph_variants:
+                yield g, f'MathVariants/{key}/{glyph}'
+    for key in ('HorizontalComponents', 'VerticalComponents'):
+        for glyph, component in variants[key].items():
+            yield glyph, f'MathVariants/{key}'
+            for part in component['parts']:
+                yield part['name'], f'MathVariants/{key}/{glyph}/parts'
+
+
+def undefined_glyphs(data: dict[str], glyph_names) -> list[str]:
+    '''Return the errors of the glyphs referenced in the expanded MATH table data which are not
+    in `glyph_names`.
+    '''
+    return [
+        f'{reference}: undefined glyph "{glyph}".'
+        for glyph, reference in glyph_references(data) if glyph not in glyph_names
+    ]
@@ -1,11 +1,28 @@
 '''OpenType MATH table.
 '''
 
+from typing import Iterable, NamedTuple
+
+import numpy as np
+from fontTools.misc.fixedTools import floatToFixed
+from fontTools.misc.roundTools import otRound
 from fontTools.ttLib.tables import otTables
+from fontTools.varLib.builder import buildVarDevTable
+from fontTools.varLib.models import VariationModel, normalizeValue
+from fontTools.varLib.varStore import OnlineVarStoreBuilder
+
+
+class VariableValue(NamedTuple):
+    '''A value of the default master with its index in the `VarStore` of a variable font.'''
+    value: int
+    var_index: int
 
 
 class MathTable:
 
+    # Corners of the cut-in kerning of a glyph, in the order of `MathKernInfoRecord`
+    MATH_KERN_SIDES = ['TopRight', 'TopLeft', 'BottomRight', 'BottomLeft']
+
     NON_MATH_VALUE_RECORD_CONSTANTS = [
         'ScriptPercentScaleDown',
         'ScriptScriptPercentScaleDown',
@@ -20,10 +37,46 @@ class MathTable:
             'ItalicCorrection': {},
             'TopAccent': {},
             'ExtendedShapes': [],
+            'MathKernInfo': {},
         }
         self.variants = {}
 
-    def encode(self):
+    def renamed(self, names: dict[str, str]) -> 'MathTable':
+        '''Return a copy of the table with the glyphs renamed by `names`, e.g. the production
+        names.
+        '''
+        def rename(glyphs: dict) -> dict:
+            return {names.get(g, g): value for g, value in glyphs.items()}
+
+        result = MathTable()
+        result.constants = self.constants
+        result.glyph_info = {
+            name: [names.get(g, g) for g in value] if isinstance(value, list) else rename(value)
+            for name, value in self.glyph_info.items()
+        }
+        result.variants = {'MinConnectorOverlap': self.variants['MinConnectorOverlap']}
+        for name in ('HorizontalVariants', 'VerticalVariants'):
+            result.variants[name] = {
+                names.get(g, g): rename(variants) for g, variants in self.variants[name].items()
+            }
+        for name in ('HorizontalComponents', 'VerticalComponents'):
+            result.variants[name] = {
+                names.get(g, g): component | {
+                    'parts': [
+                        part | {'name': names.get(part['name'], part['name'])}
+                        for part in component['parts']
+                    ],
+                }
+                for g, component in self.variants[name].items()
+            }
+        return result
+
+    def encode(self, var_index_map: dict[int, int] = None):
+        '''Return the `otTables.MATH` table. For a variable font, `var_index_map` maps the
+        variation indices of `VariableValue`s to their final values, e.g. after merging their
+        `VarStore` into the one of GDEF.
+        '''
+        self._var_index_map = var_index_map or {}
         table = otTables.MATH()
         table.Version = 0x00010000
         table.MathConstants = self._encode_constants()
@@ -51,7 +104,7 @@ class MathTable:
         glyph_info.MathItalicsCorrectionInfo = italic_corr
         glyph_info.MathTopAccentAttachment = top_accent
         glyph_info.ExtendedShapeCoverage = self._coverage(self.glyph_info['ExtendedShapes'])
-        glyph_info.MathKernInfo = None
+        glyph_info.MathKernInfo = self._encode_kern_info()
         return glyph_info
 
     def _glyph_info(self, name: str):
@@ -61,6 +114,37 @@ class MathTable:
             len(self.glyph_info[name])
         )
 
+    def _encode_kern_info(self):
+        kerns = self.glyph_info.get('MathKernInfo')
+        if not kerns:
+            return None
+        # Identical kerns (e.g. of a glyph and its alternates) share a single `MathKern` table.
+        shared_kerns = {}
+        records = []
+        for glyph_kerns in kerns.values():
+            record = otTables.MathKernInfoRecord()
+            for side in self.MATH_KERN_SIDES:
+                kern = glyph_kerns.get(side)
+                if kern is not None:
+                    key = (tuple(kern['correctionHeights']), tuple(kern['kernValues']))
+                    if key not in shared_kerns:
+                        shared_kerns[key] = self._math_kern(kern)
+                    kern = shared_kerns[key]
+                setattr(record, f'{side}MathKern', kern)
+            records.append(record)
+        info = otTables.MathKernInfo()
+        info.MathKernInfoRecords = records
+        info.MathKernCoverage = self._coverage(kerns.keys())
+        info.MathKernCount = len(records)
+        return info
+
+    def _math_kern(self, kern: dict[str, list]):
+        t = otTables.MathKern()
+        t.HeightCount = len(kern['correctionHeights'])
+        t.CorrectionHeight = list(map(self._math_value, kern['correctionHeights']))
+        t.KernValue = list(map(self._math_value, kern['kernValues']))
+        return t
+
     def _encode_variants(self):
         variants = otTables.MathVariants()
         variants.MinConnectorOverlap = self.variants['MinConnectorOverlap']
@@ -93,10 +177,9 @@ class MathTable:
             construction.MathGlyphVariantRecord.append(r)
         return construction
 
-    @staticmethod
-    def _glyph_assembly(component: dict):
+    def _glyph_assembly(self, component: dict):
         t = otTables.GlyphAssembly()
-        t.ItalicsCorrection = MathTable._math_value(component['italicsCorrection'])
+        t.ItalicsCorrection = self._math_value(component['italicsCorrection'])
         t.PartCount = len(component['parts'])
         t.PartRecords = []
         for part in component['parts']:
@@ -109,11 +192,15 @@ class MathTable:
             t.PartRecords.append(r)
         return t
 
-    @staticmethod
-    def _math_value(value):
+    def _math_value(self, value):
         t = otTables.MathValueRecord()
-        t.DeviceTable = None
-        t.Value = value
+        if isinstance(value, VariableValue):
+            var_index = self._var_index_map.get(value.var_index, value.var_index)
+            t.DeviceTable = buildVarDevTable(var_index)
+            t.Value = value.value
+        else:
+            t.DeviceTable = None
+            t.Value = value
         return t
 
     @staticmethod
@@ -123,83 +210,320 @@ class MathTable:
         return c
 
 
-class MathTableInstantiator:
+class MathGlyphClosure:
+    '''The glyphs that code points pull into a subset through the MATH table.
+
+    A glyph pulls in its horizontal and vertical variants and the parts of its glyph assemblies,
+    transitively, plus its `alternates` (e.g. from the `ssty` feature). The glyph info
+    (`ItalicCorrection`, `TopAccent`, `ExtendedShapes`) only describes glyphs, so it is pruned to
+    the closure and pulls in nothing.
+
+    The closure of every mapped code point is precomputed, so that `glyphs()` is a union of
+    precomputed sets, and `codepoints()` looks up the reverse index of the code points pulling in
+    each glyph.
+    '''
 
     def __init__(
         self,
-        data: dict[str],
-        interpolation: list[tuple[int, float]],
-        removed_glyphs: list[str],
+        variants: dict[str],
+        cmap: dict[int, str],
+        alternates: dict[str, list[str]] = None,
     ):
-        self.master_constants:  dict[str, dict] = data['MathConstants']
-        self.master_glyph_info: dict[str]       = data['MathGlyphInfo']
-        self.master_variants:   dict[str]       = data['MathVariants']
-        self.interpolation  = interpolation
-        self.removed_glyphs = set(removed_glyphs) if removed_glyphs else set()
+        '''`variants` is `MathTable.variants` (or the `MathVariants` of the master data), and
+        `cmap` maps code points to glyph names.
+        '''
+        # Glyph name -> glyphs it pulls in directly
+        self._edges: dict[str, set[str]] = {}
+        for key in ('HorizontalVariants', 'VerticalVariants'):
+            for glyph, glyph_variants in variants[key].items():
+                self._edges.setdefault(glyph, set()).update(glyph_variants)
+        for key in ('HorizontalComponents', 'VerticalComponents'):
+            for glyph, component in variants[key].items():
+                self._edges.setdefault(glyph, set()).update(p['name'] for p in component['parts'])
+        for glyph, glyph_alternates in (alternates or {}).items():
+            self._edges.setdefault(glyph, set()).update(glyph_alternates)
+        # Glyph name -> closure, computed on demand and shared by the code points
+        self._glyph_closures: dict[str, frozenset[str]] = {}
+        # Code point -> closure of its glyph
+        self._closures: dict[int, frozenset[str]] = {
+            c: self.glyph_closure(glyph) for c, glyph in cmap.items()
+        }
+        # Glyph name -> code points pulling it in
+        self._codepoints: dict[str, set[int]] = {}
+        for c, closure in self._closures.items():
+            for glyph in closure:
+                self._codepoints.setdefault(glyph, set()).add(c)
 
-    def generate(self) -> MathTable:
-        math_table = MathTable()
-        math_table.constants  = self._generate_constants()
-        math_table.glyph_info = self._generate_glyph_info()
-        math_table.variants   = self._generate_variants()
-        return math_table
+    def glyph_closure(self, glyph: str) -> frozenset[str]:
+        '''Return `glyph` and all the glyphs it pulls in.'''
+        if glyph not in self._glyph_closures:
+            closure = {glyph}
+            stack = [glyph]
+            while stack:
+                for g in self._edges.get(stack.pop(), ()):
+                    if g not in closure:
+                        closure.add(g)
+                        stack.append(g)
+            self._glyph_closures[glyph] = frozenset(closure)
+        return self._glyph_closures[glyph]
 
-    def _generate_constants(self) -> dict[str, dict[str]]:
-        return {
-            name: self._generate(value)
-            for name, value in self.master_constants.items()
-        }
+    def glyphs(self, codepoints: Iterable[int]) -> set[str]:
+        '''Return the glyphs of `codepoints` and all the glyphs they pull in. Unmapped code
+        points are ignored.
+        '''
+        closures = self._closures
+        return set().union(*(closures[c] for c in codepoints if c in closures))
 
-    def _generate(self, values: list[int]) -> int:
-        '''Generate a specific value for the instance.'''
-        return round(sum(values[i] * v for i, v in self.interpolation))
+    def codepoints(self, glyph: str) -> set[int]:
+        '''Return the code points whose closure contains `glyph`.'''
+        return self._codepoints.get(glyph, set())
 
-    def _generate_glyph_info(self) -> dict[str]:
-        return {
-            'ItalicCorrection': self._glyph_info('ItalicCorrection'),
-            'TopAccent':        self._glyph_info('TopAccent'),
-            'ExtendedShapes':   self.master_glyph_info['ExtendedShapes'],
-        }
 
-    def _glyph_info(self, name: str) -> dict[str]:
-        # TODO: consider brace layers
-        return {
-            g: self._generate(values)
-            for g, values in self.master_glyph_info[name].items() if g not in self.removed_glyphs
+class MathTableInstantiator:
+    '''Generate the MATH tables of instances from the master data.
+
+    All the interpolated values (constants, glyph info, variant advances and assembly part
+    metrics) are packed into one matrix with a row per value and a column per master. The values
+    of any number of instances are then a single product with the matrix of instance weights.
+    '''
+
+    def __init__(self, data: dict[str], master_locations: list[float] = None):
+        '''`master_locations` (e.g. the weight values of the masters) is only needed for
+        `interpolation_at()`, `generate_at()` and `generate_variable()`.
+        '''
+        self.master_locations = master_locations
+        self._rows: list[list[int]] = []
+        self._constants = {
+            name: self._add_row(values, name) for name, values in data['MathConstants'].items()
+        }
+        glyph_info = data['MathGlyphInfo']
+        self._glyph_info = {
+            name: {g: self._add_row(values, name, g) for g, values in glyph_info[name].items()}
+            for name in ('ItalicCorrection', 'TopAccent')
         }
+        self._extended_shapes = glyph_info['ExtendedShapes']
+        # Glyph name -> side -> {'correctionHeights': rows, 'kernValues': rows}
+        self._math_kerns = {
+            glyph: {
+                side: {
+                    name: [self._add_row(v, 'MathKernInfo', glyph, side, name) for v in values]
+                    for name, values in kern.items()
+                }
+                for side, kern in kerns.items()
+            }
+            for glyph, kerns in glyph_info.get('MathKernInfo', {}).items()
+        }
+        variants = data['MathVariants']
+        self._variants = {
+            'MinConnectorOverlap': self._add_row(
+                variants['MinConnectorOverlap'], 'MinConnectorOverlap'
+            ),
+        }
+        for name in ('HorizontalVariants', 'VerticalVariants'):
+            self._variants[name] = {
+                glyph: {g: self._add_row(values, name, g) for g, values in glyph_variants.items()}
+                for glyph, glyph_variants in variants[name].items()
+            }
+        for name in ('HorizontalComponents', 'VerticalComponents'):
+            self._variants[name] = {
+                glyph: {
+                    # TODO: need to be interpolated
+                    'italicsCorrection': component['italicsCorrection'],
+                    'parts': [self._part_rows(part, name, glyph) for part in component['parts']],
+                }
+                for glyph, component in variants[name].items()
+            }
+        # Shape: (values, masters)
+        self._values = np.array(self._rows, dtype=float)
 
-    def _generate_variants(self) -> dict[str]:
+    def _add_row(self, values: list[int], *path: str) -> int:
+        '''Add the master values of a single value, and return its row index.'''
+        if self._rows and len(values) != len(self._rows[0]):
+            raise ValueError(
+                f'{"/".join(path)}: expected {len(self._rows[0])} master values, got {values}.'
+            )
+        self._rows.append(values)
+        return len(self._rows) - 1
+
+    def _part_rows(self, part: dict[str], *path: str) -> dict[str]:
+        path = (*path, part['name'])
         return {
-            'MinConnectorOverlap':  self._generate(self.master_variants['MinConnectorOverlap']),
-            'HorizontalVariants':   self._variants('Horizontal'),
-            'VerticalVariants':     self._variants('Vertical'),
-            'HorizontalComponents': self._components('Horizontal'),
-            'VerticalComponents':   self._components('Vertical'),
+            'name':           part['name'],
+            'isExtender':     part['isExtender'],
+            'startConnector': self._add_row(part['startConnector'], *path, 'startConnector'),
+            'endConnector':   self._add_row(part['endConnector'], *path, 'endConnector'),
+            'fullAdvance':    self._add_row(part['fullAdvance'], *path, 'fullAdvance'),
         }
 
-    def _variants(self, name: str) -> dict[str]:
-        '''`name` can be either `"Horizontal"` or `"Vertical"`.'''
+    def generate(
+        self,
+        interpolation: list[tuple[int, float]],
+        removed_glyphs: list[str] = None,
+    ) -> MathTable:
+        '''Generate the MATH table of a single instance.'''
+        return self.generate_all({None: interpolation}, {None: removed_glyphs})[None]
+
+    def generate_all(
+        self,
+        interpolations: dict[str, list[tuple[int, float]]],
+        removed_glyphs: dict[str, list[str]] = None,
+    ) -> dict[str, MathTable]:
+        '''Generate the MATH tables of all the instances in `interpolations`, which maps instance
+        names to `(master index, weight)` pairs. The glyphs in `removed_glyphs[name]` are left
+        out of the glyph info of the instance.
+        '''
+        names = list(interpolations)
+        # Shape: (masters, instances)
+        weights = np.zeros((self._values.shape[1], len(names)))
+        for j, name in enumerate(names):
+            for i, v in interpolations[name]:
+                weights[i, j] += v
+        # Shape: (instances, values)
+        values = np.rint(self._values @ weights).astype(int).T.tolist()
+        removed_glyphs = removed_glyphs or {}
         return {
-            glyph: {g: self._generate(values) for g, values in variants.items()}
-            for glyph, variants in self.master_variants[name + 'Variants'].items()
+            name: self._math_table(instance_values, set(removed_glyphs.get(name) or ()))
+            for name, instance_values in zip(names, values)
         }
 
-    def _components(self, name: str) -> dict[str]:
-        '''`name` can be either `"Horizontal"` or `"Vertical"`.'''
-        return {
+    def interpolation_at(self, location: float) -> list[tuple[int, float]]:
+        '''Return the `(master index, weight)` pairs of an arbitrary `location`, by linear
+        interpolation between the 2 nearest masters (or extrapolation beyond the extreme ones).
+        '''
+        order = sorted(range(len(self.master_locations)), key=self.master_locations.__getitem__)
+        if len(order) == 1:
+            return [(order[0], 1)]
+        # The first pair of masters whose segment contains `location`, or the extreme pair
+        for i, j in zip(order, order[1:]):
+            if location <= self.master_locations[j]:
+                break
+        a, b = self.master_locations[i], self.master_locations[j]
+        t = (location - a) / (b - a)
+        return [(i, 1 - t), (j, t)]
+
+    def generate_at(self, location: float, removed_glyphs: list[str] = None) -> MathTable:
+        '''Generate the MATH table of an arbitrary `location` (in the units of
+        `master_locations`), e.g. a weight between the named instances. The glyphs in
+        `removed_glyphs` are left out of the glyph info.
+
+        Between the masters, the table is the same as the one of a named instance at the same
+        location. Beyond the extreme masters, the linear extrapolation can differ from the
+        instance interpolation of Glyphs.
+        '''
+        return self.generate_all(
+            {location: self.interpolation_at(location)}, {location: removed_glyphs}
+        )[location]
+
+    def generate_variable(
+        self,
+        axis_tag: str,
+        axis: tuple[float, float, float],
+    ) -> tuple[MathTable, otTables.VarStore]:
+        '''Generate the MATH table of a variable font with a single axis `axis_tag`, whose
+        `(minimum, default, maximum)` is `axis` (in the units of `master_locations`).
+
+        The values stored in `MathValueRecord`s vary: they get variation indices into the
+        returned `VarStore`, which has to be merged into the one of GDEF (see
+        `merge_var_store()`). The other values can't vary in OpenType, and are the ones of the
+        default master.
+        '''
+        locations = [{axis_tag: normalizeValue(loc, axis)} for loc in self.master_locations]
+        if {axis_tag: 0} not in locations:
+            raise ValueError(f'No master at the default location {axis[1]} of "{axis_tag}".')
+        builder = OnlineVarStoreBuilder([axis_tag])
+        builder.setModel(VariationModel(locations, axisOrder=[axis_tag]))
+        values: list = self._values[:, locations.index({axis_tag: 0})].astype(int).tolist()
+        for row in self._math_value_rows():
+            master_values = self._values[row].tolist()
+            if len(set(master_values)) > 1:
+                values[row] = VariableValue(*builder.storeMasters(master_values, round=otRound))
+        return self._math_table(values, set()), builder.finish()
+
+    def _math_value_rows(self) -> list[int]:
+        '''Return the rows of the values stored in `MathValueRecord`s.'''
+        rows = [
+            row for name, row in self._constants.items()
+            if name not in MathTable.NON_MATH_VALUE_RECORD_CONSTANTS
+        ]
+        for glyph_rows in self._glyph_info.values():
+            rows.extend(glyph_rows.values())
+        for kerns in self._math_kerns.values():
+            for kern in kerns.values():
+                for kern_rows in kern.values():
+                    rows.extend(kern_rows)
+        return rows
+
+    def _math_table(self, values: list[int], removed_glyphs: set[str]) -> MathTable:
+        math_table = MathTable()
+        math_table.constants = {name: values[row] for name, row in self._constants.items()}
+        math_table.glyph_info = {
+            name: {g: values[row] for g, row in rows.items() if g not in removed_glyphs}
+            for name, rows in self._glyph_info.items()
+        }
+        math_table.glyph_info['ExtendedShapes'] = self._extended_shapes
+        math_table.glyph_info['MathKernInfo'] = {
             glyph: {
-                # TODO: need to be interpolated
-                'italicsCorrection': componet['italicsCorrection'],
-                'parts': list(map(self._part, componet['parts'])),
+                side: {name: [values[row] for row in rows] for name, rows in kern.items()}
+                for side, kern in kerns.items()
             }
-            for glyph, componet in self.master_variants[name + 'Components'].items()
+            for glyph, kerns in self._math_kerns.items() if glyph not in removed_glyphs
         }
+        variants = {'MinConnectorOverlap': values[self._variants['MinConnectorOverlap']]}
+        for name in ('HorizontalVariants', 'VerticalVariants'):
+            variants[name] = {
+                glyph: {g: values[row] for g, row in rows.items()}
+                for glyph, rows in self._variants[name].items()
+            }
+        for name in ('HorizontalComponents', 'VerticalComponents'):
+            variants[name] = {
+                glyph: {
+                    'italicsCorrection': component['italicsCorrection'],
+                    'parts': [
+                        {
+                            'name':           part['name'],
+                            'isExtender':     part['isExtender'],
+                            'startConnector': values[part['startConnector']],
+                            'endConnector':   values[part['endConnector']],
+                            'fullAdvance':    values[part['fullAdvance']],
+                        }
+                        for part in component['parts']
+                    ],
+                }
+                for glyph, component in self._variants[name].items()
+            }
+        math_table.variants = variants
+        return math_table
 
-    def _part(self, part: dict[str]) -> dict[str]:
-        return {
-            'name':           part['name'],
-            'isExtender':     part['isExtender'],
-            'startConnector': self._generate(part['startConnector']),
-            'endConnector':   self._generate(part['endConnector']),
-            'fullAdvance':    self._generate(part['fullAdvance']),
-        }
+
+def merge_var_store(target: otTables.VarStore, source: otTables.VarStore) -> dict[int, int]:
+    '''Append the variation data of `source` to `target`, which must have the same axes, and
+    return the mapping from the variation indices in `source` to the ones in `target`.
+    '''
+    regions = target.VarRegionList.Region
+    region_indices = {_region_key(r): i for i, r in enumerate(regions)}
+    # Region index in `source` -> region index in `target`
+    region_map = []
+    for region in source.VarRegionList.Region:
+        key = _region_key(region)
+        if key not in region_indices:
+            region_indices[key] = len(regions)
+            regions.append(region)
+        region_map.append(region_indices[key])
+    target.VarRegionList.RegionCount = len(regions)
+    var_index_map = {}
+    for outer, var_data in enumerate(source.VarData):
+        var_data.VarRegionIndex = [region_map[i] for i in var_data.VarRegionIndex]
+        new_outer = len(target.VarData)
+        target.VarData.append(var_data)
+        for inner in range(var_data.ItemCount):
+            var_index_map[outer << 16 | inner] = new_outer << 16 | inner
+    target.VarDataCount = len(target.VarData)
+    return var_index_map
+
+
+def _region_key(region) -> tuple:
+    # The coordinates are stored as F2Dot14, so regions equal after rounding are the same.
+    return tuple(
+        tuple(floatToFixed(c, 14) for c in (a.StartCoord, a.PeakCoord, a.EndCoord))
+        for a in region.VarRegionAxis
+    )
@@ -0,0 +1,177 @@
+'''Build metrics and profiling.
+
+`Metrics` records the wall time of each build stage and each style, the peak memory, the
+utilisation of the worker processes, glyph counts and cache hit rates, and writes them as JSON so
+that build times can be compared across commits.
+
+With a profiler (`'cprofile'`, or `'pyinstrument'` if installed), each stage and each style is
+also profiled into its own file.
+'''
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from typing import Callable
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+
+class Metrics:
+
+    def __init__(self, profiler: str = None, profile_dir: str = None):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f'Unknown profiler "{profiler}", should be one of: {PROFILERS}')
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.start_time = time.perf_counter()
+        # Stage name -> wall time in seconds
+        self.stages: dict[str, float] = {}
+        # Style name -> metrics of the style, see `InstanceTimer.result()`
+        self.instances: dict[str, dict] = {}
+        # Stage name -> (busy time of all the workers, wall time, number of workers)
+        self._pools: dict[str, tuple[float, float, int]] = {}
+        self.counts: dict[str, int] = {}
+        # Cache name -> function returning (hits, misses), called when the metrics are written
+        self._caches: dict[str, Callable[[], tuple[int, int]]] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str, profiled: bool = True):
+        '''Time the code in the `with` block as stage `name`, and profile it if `profiled`
+        (stages which wait for worker processes are profiled per style instead).
+        '''
+        with profile(self.profiler if profiled else None, self.profile_path(name)):
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start_time
+
+    def profile_path(self, name: str) -> str:
+        return profile_path(self.profiler, self.profile_dir, name)
+
+    def add_instance(self, style: str, metrics: dict):
+        '''Record the `metrics` of a style, as returned by `InstanceTimer.result()`.'''
+        self.instances[style] = metrics
+
+    def add_pool(self, stage: str, wall_time: float, workers: int, busy_times: list[float]):
+        '''Record the busy time of the tasks run by `workers` worker processes during
+        `wall_time`.
+        '''
+        self._pools[stage] = (sum(busy_times), wall_time, workers)
+
+    def add_cache(self, name: str, counter: Callable[[], tuple[int, int]]):
+        '''Record the hits and misses of a cache, as returned by `counter()` at the end.'''
+        self._caches[name] = counter
+
+    def to_dict(self) -> dict[str]:
+        return {
+            'python': sys.version.split()[0],
+            'cpu_count': os.cpu_count(),
+            'total_time': time.perf_counter() - self.start_time,
+            'stages': self.stages,
+            'instances': self.instances,
+            'workers': {
+                stage: {
+                    'workers': workers,
+                    'wall_time': wall_time,
+                    'busy_time': busy_time,
+                    'utilisation': busy_time / (wall_time * workers) if wall_time else 0,
+                }
+                for stage, (busy_time, wall_time, workers) in self._pools.items()
+            },
+            'peak_rss': {
+                'main': peak_rss(),
+                'workers': peak_rss(resource.RUSAGE_CHILDREN),
+            },
+            'counts': self.counts,
+            'caches': {
+                name: {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': hits / (hits + misses) if hits + misses else None,
+                }
+                for name, (hits, misses) in ((n, c()) for n, c in self._caches.items())
+            },
+        }
+
+    def write(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+
+class InstanceTimer:
+    '''Time the steps of building a style, possibly in a worker process.'''
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.steps: dict[str, float] = {}
+        self._step_start = self.start_time
+
+    def step(self, name: str):
+        '''Record the time since the previous step as step `name`.'''
+        now = time.perf_counter()
+        self.steps[name] = now - self._step_start
+        self._step_start = now
+
+    def result(self, **values) -> dict[str]:
+        return {
+            'time': time.perf_counter() - self.start_time,
+            'steps': self.steps,
+            'pid': os.getpid(),
+            'peak_rss': peak_rss(),
+        } | values
+
+
+@contextlib.contextmanager
+def profile(profiler: str, path: str):
+    '''Profile the code in the `with` block with `profiler` (or not if `None`) and save the
+    result to `path`.
+    '''
+    if profiler is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if profiler == 'cprofile':
+        p = cProfile.Profile()
+        p.enable()
+        try:
+            yield
+        finally:
+            p.disable()
+            p.dump_stats(path)
+        return
+    try:
+        import pyinstrument  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise RuntimeError('pyinstrument is not installed.') from None
+    p = pyinstrument.Profiler()
+    p.start()
+    try:
+        yield
+    finally:
+        p.stop()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(p.output_html())
+
+
+def profile_path(profiler: str, profile_dir: str, name: str) -> str:
+    '''Return the path of the profile of `name`, or `None` without profiler.'''
+    if profiler is None:
+        return None
+    extension = '.prof' if profiler == 'cprofile' else '.html'
+    return os.path.join(profile_dir, name + extension)
+
+
+def peak_rss(who: int = resource.RUSAGE_SELF) -> int:
+    '''Return the peak resident set size in bytes, of this process (`RUSAGE_SELF`) or of the
+    largest terminated child process (`RUSAGE_CHILDREN`).
+    '''
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
@@ -0,0 +1,137 @@
+'''Smart component interpolation.
+'''
+
+import copy
+import itertools
+
+import numpy as np
+from glyphsLib import GSComponent, GSGlyph, GSLayer, GSNode, GSPath
+
+
+class SmartGlyph:
+    '''A smart glyph whose part layers are packed into coordinate arrays.
+
+    All the components referencing the glyph can be interpolated at once with `to_paths()`. With
+    n smart component axes, each master has 2^n part layers (the "corners", selected by
+    `partSelection`), and the components are n-linearly interpolated between them.
+    '''
+
+    def __init__(self, glyph: GSGlyph):
+        self.glyph = glyph
+        self.axes = list(glyph.smartComponentAxes)
+        # Part of each axis (1 or 2) for each corner, e.g. (1, 1), (1, 2), (2, 1), (2, 2)
+        self.corners = list(itertools.product((1, 2), repeat=len(self.axes)))
+        # Master ID -> (paths, node types, coordinates with shape (corners, nodes, 2))
+        self._parts: dict[str, tuple] = {}
+        # (master ID, corner) -> part layer
+        self._part_layers: dict[tuple, GSLayer] = {}
+        axis_names = {axis.name for axis in self.axes}
+        for layer in glyph.layers:
+            if not layer.partSelection or layer.partSelection.keys() - axis_names:
+                continue
+            # Axes missing in `partSelection` match both parts.
+            choices = [
+                [layer.partSelection[axis.name]] if axis.name in layer.partSelection else [1, 2]
+                for axis in self.axes
+            ]
+            for corner in itertools.product(*choices):
+                self._part_layers.setdefault((layer.associatedMasterId, corner), layer)
+
+    def to_paths(self, comps: list[GSComponent]) -> list[list[GSPath]]:
+        '''Return the paths of each component in `comps`, by interpolating between the part
+        layers of the smart glyph.
+        '''
+        groups: dict[str, list[int]] = {}
+        for i, comp in enumerate(comps):
+            groups.setdefault(comp.parent.associatedMasterId, []).append(i)
+        result = [None] * len(comps)
+        for master_id, indices in groups.items():
+            group_paths = self._interpolate(
+                master_id,
+                np.array([self._interpolation_values(comps[i]) for i in indices], dtype=float),
+                [comps[i].transform for i in indices],
+            )
+            for i, paths in zip(indices, group_paths):
+                result[i] = paths
+        return result
+
+    def _interpolation_values(self, comp: GSComponent) -> list[float]:
+        '''Return the interpolation value in [0, 1] of each axis. Axes without smart component
+        values use part 1.
+        '''
+        values: dict = comp.smartComponentValues
+        if unknown := values.keys() - {axis.name for axis in self.axes}:
+            raise ValueError(f'Unknown smart component axes of "{self.glyph.name}": {unknown}')
+        return [
+            _rescale(values[axis.name], axis.bottomValue, axis.topValue)
+            if axis.name in values else 0
+            for axis in self.axes
+        ]
+
+    def _interpolate(self, master_id: str, values: np.ndarray, transforms: list) -> list:
+        '''`values` has shape (components, axes).'''
+        paths, node_types, coords = self._part_arrays(master_id)
+        # Weight of each corner for each component, with shape (components, corners)
+        weights = np.ones((len(values), len(self.corners)))
+        for j, corner in enumerate(self.corners):
+            for k, part in enumerate(corner):
+                weights[:, j] *= values[:, k] if part == 2 else 1 - values[:, k]
+        # Shape: (components, nodes, 2). The loop over corners keeps the same arithmetic (and
+        # rounding) as interpolating node by node between 2 layers.
+        result_coords = coords[0] * weights[:, 0, np.newaxis, np.newaxis]
+        for j in range(1, len(self.corners)):
+            result_coords = result_coords + coords[j] * weights[:, j, np.newaxis, np.newaxis]
+        result_coords = np.rint(result_coords)
+        # Affine transformations `(xx, xy, yx, yy, dx, dy)`, applied as `coords @ matrix + offset`
+        matrices = np.array([[[m[0], m[1]], [m[2], m[3]]] for m in transforms], dtype=float)
+        offsets = np.array([[m[4], m[5]] for m in transforms], dtype=float)[:, np.newaxis, :]
+        transformed = np.matmul(result_coords, matrices) + offsets
+        result = []
+        for i, transform in enumerate(transforms):
+            if tuple(transform) == (1, 0, 0, 1, 0, 0):
+                positions = result_coords[i].astype(int).tolist()
+            else:
+                positions = transformed[i].tolist()
+            result.append(self._new_paths(paths, node_types, positions))
+        return result
+
+    @staticmethod
+    def _new_paths(paths: list[GSPath], node_types: list[list], positions: list) -> list[GSPath]:
+        result = []
+        positions = iter(positions)
+        for path, types in zip(paths, node_types):
+            new_path = copy.copy(path)
+            new_path.nodes = [
+                GSNode(position, type=node_type, smooth=smooth)
+                for (node_type, smooth), position in zip(types, positions)
+            ]
+            result.append(new_path)
+        return result
+
+    def _part_arrays(self, master_id: str) -> tuple:
+        if master_id not in self._parts:
+            layers = [self._part_layer(master_id, corner) for corner in self.corners]
+            paths, node_types, nodes = [], [], []
+            for corner_paths in zip(*(layer.paths for layer in layers)):
+                corner_nodes = list(zip(*(path.nodes for path in corner_paths)))
+                paths.append(corner_paths[0])
+                node_types.append([(n[0].type, n[0].smooth) for n in corner_nodes])
+                nodes.extend(corner_nodes)
+            coords = np.array(
+                [[(n.position.x, n.position.y) for n in corner] for corner in zip(*nodes)],
+                dtype=float,
+            ).reshape(len(layers), -1, 2)
+            self._parts[master_id] = (paths, node_types, coords)
+        return self._parts[master_id]
+
+    def _part_layer(self, master_id: str, corner: tuple[int]) -> GSLayer:
+        try:
+            return self._part_layers[master_id, corner]
+        except KeyError:
+            parts = {axis.name: part for axis, part in zip(self.axes, corner)}
+            raise ValueError(f'Glyph "{self.glyph.name}" has no layer for parts {parts}.') from None
+
+
+def _rescale(x, bottom, top):
+    '''Return rescaled `x` to run from 0 to 1 over the range `bottom` to `top`.'''
+    return (x - bottom) / (top - bottom)
@@ -0,0 +1,262 @@
+'''Check the MATH tables of the built fonts, and the MATH data of the source.
+
+The source is loaded as a `build.Font`, so that the checks read the same MATH userData index and
+production names as the build. The fonts are then checked in parallel:
+
+- `variant-advances`: the variants of each glyph are sorted by strictly increasing advance.
+- `connector-overlap`: adjacent parts of each glyph assembly (and an extender with itself) can
+  overlap by at least `MinConnectorOverlap`, and no connector is longer than its part.
+- `coverage`: every glyph referenced in `FiraMath.toml` is in the font, and has its variants,
+  assembly or extended shape flag in the MATH table.
+- `master-data`: the MATH values in the userData of the master layers are compatible for
+  interpolation, i.e. each glyph has them in all the masters or in none, the assembly parts in
+  the MATH plugin data are the same in all the masters, and the parts of the assemblies in
+  `FiraMath.toml` have their connector lengths in all the masters.
+
+The issues are printed, and written as JSON with `--output`. The exit status is 1 if there is
+any issue.
+'''
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+from fontTools.ttLib import TTFont
+
+import math_spec
+from build import MATH_USER_DATA_KEYS, Font, eprint, map_with_errors
+from glyphs_package import MATH_VARIANTS_KEY
+
+
+def _issue(check: str, glyph: str, message: str) -> dict[str, str]:
+    return {'check': check, 'glyph': glyph, 'message': message}
+
+
+def validate_font(
+    font_path: str,
+    toml_path: str,
+    production_names: dict[str, str],
+) -> list[dict[str, str]]:
+    '''Return the issues of the MATH table of the OTF `font_path`. `production_names` maps the
+    glyph names of the MATH table data to the ones of the font (see `Font.production_names`).
+    '''
+    with TTFont(font_path, lazy=True) as tt_font:
+        glyph_order = set(tt_font.getGlyphOrder())
+        if 'MATH' not in tt_font:
+            return [_issue('coverage', None, 'No MATH table.')]
+        table = tt_font['MATH'].table
+        variants = table.MathVariants
+        constructions = {
+            'Horizontal': _constructions(
+                variants.HorizGlyphCoverage, variants.HorizGlyphConstruction
+            ),
+            'Vertical': _constructions(variants.VertGlyphCoverage, variants.VertGlyphConstruction),
+        }
+        extended_shapes = table.MathGlyphInfo.ExtendedShapeCoverage
+        extended_shapes = set(extended_shapes.glyphs if extended_shapes else ())
+        issues = []
+        for construction in constructions.values():
+            for glyph, c in construction.items():
+                issues.extend(_check_variant_advances(glyph, c))
+                if c.GlyphAssembly:
+                    issues.extend(
+                        _check_connectors(glyph, c.GlyphAssembly, variants.MinConnectorOverlap)
+                    )
+    data = math_spec.load(toml_path)
+    issues.extend(
+        _check_font_coverage(data, production_names, glyph_order, constructions, extended_shapes)
+    )
+    return issues
+
+
+def _constructions(coverage, constructions) -> dict[str]:
+    if coverage is None:
+        return {}
+    return dict(zip(coverage.glyphs, constructions))
+
+
+def _check_variant_advances(glyph: str, construction):
+    records = construction.MathGlyphVariantRecord
+    for a, b in zip(records, records[1:]):
+        if b.AdvanceMeasurement <= a.AdvanceMeasurement:
+            yield _issue(
+                'variant-advances', glyph,
+                f'"{b.VariantGlyph}" ({b.AdvanceMeasurement}) is not larger than '
+                f'"{a.VariantGlyph}" ({a.AdvanceMeasurement}).'
+            )
+
+
+def _check_connectors(glyph: str, assembly, min_overlap: int):
+    parts = assembly.PartRecords
+    for part in parts:
+        for name in ('StartConnectorLength', 'EndConnectorLength'):
+            if getattr(part, name) > part.FullAdvance:
+                yield _issue(
+                    'connector-overlap', glyph,
+                    f'{name} of "{part.glyph}" ({getattr(part, name)}) is larger than its '
+                    f'FullAdvance ({part.FullAdvance}).'
+                )
+    # An extender can also be connected to itself.
+    pairs = list(zip(parts, parts[1:])) + [(p, p) for p in parts if p.PartFlags & 0x0001]
+    for a, b in pairs:
+        overlap = min(a.EndConnectorLength, b.StartConnectorLength)
+        if overlap < min_overlap:
+            yield _issue(
+                'connector-overlap', glyph,
+                f'"{a.glyph}" -> "{b.glyph}" can only overlap by {overlap}, less than '
+                f'MinConnectorOverlap ({min_overlap}).'
+            )
+
+
+def _check_font_coverage(
+    data: dict[str],
+    production_names: dict[str, str],
+    glyph_order: set[str],
+    constructions: dict[str, dict[str]],
+    extended_shapes: set[str],
+):
+    # The MATH table data uses the source glyph names, and the fonts the production names.
+    def production_name(glyph: str) -> str:
+        return production_names.get(glyph, glyph)
+
+    for glyph in data['MathGlyphInfo']['ExtendedShapes']:
+        if production_name(glyph) not in extended_shapes:
+            yield _issue('coverage', glyph, 'Missing from ExtendedShapeCoverage.')
+    variants = data['MathVariants']
+    for direction, construction in constructions.items():
+        for glyph, glyph_variants in variants[f'{direction}Variants'].items():
+            if production_name(glyph) not in construction:
+                yield _issue('coverage', glyph, f'Missing from the {direction} variants.')
+            for g in glyph_variants:
+                if production_name(g) not in glyph_order:
+                    yield _issue('coverage', g, f'Variant of "{glyph}" missing from the font.')
+        for glyph, component in variants[f'{direction}Components'].items():
+            c = construction.get(production_name(glyph))
+            if c is None or c.GlyphAssembly is None:
+                yield _issue('coverage', glyph, f'Missing {direction} assembly.')
+            for part in component['parts']:
+                if production_name(part['name']) not in glyph_order:
+                    yield _issue(
+                        'coverage', part['name'], f'Part of "{glyph}" missing from the font.'
+                    )
+
+
+def validate_source(font: Font, toml_path: str) -> list[dict[str, str]]:
+    '''Return the issues of the MATH data in the Glyphs source loaded as `font`.'''
+    data = math_spec.load(toml_path)
+    master_ids = {m.id for m in font.font.masters}
+    issues = []
+    for key in MATH_USER_DATA_KEYS:
+        for glyph, values in font.master_user_data(key).items():
+            if len(values) != len(master_ids):
+                issues.append(_issue(
+                    'master-data', glyph,
+                    f'"{key}" is in {len(values)} of the {len(master_ids)} master layers.'
+                ))
+    glyphs = {g.name: g for g in font.font.glyphs}
+    for glyph in glyphs.values():
+        # Assembly name -> the different (part name, extender flag) lists of the layers
+        assemblies: dict[str, set[tuple]] = {}
+        for layer in glyph.layers:
+            if layer.layerId not in master_ids:
+                continue
+            plugin_data = layer.userData.get(MATH_VARIANTS_KEY) or {}
+            for name in ('hAssembly', 'vAssembly'):
+                parts = tuple((p[0], p[1]) for p in plugin_data.get(name, ()))
+                assemblies.setdefault(name, set()).add(parts)
+        for name, parts in assemblies.items():
+            if len(parts) > 1:
+                issues.append(_issue(
+                    'master-data', glyph.name,
+                    f'The {name} parts differ between the master layers: {sorted(parts)}.'
+                ))
+    for glyph, reference in math_spec.glyph_references(data):
+        if glyph not in glyphs:
+            issues.append(_issue('coverage', glyph, f'Missing from the source ({reference}).'))
+        elif not glyphs[glyph].export:
+            issues.append(_issue('coverage', glyph, f'Not exported ({reference}).'))
+    for key in ('HorizontalComponents', 'VerticalComponents'):
+        for glyph, component in data['MathVariants'][key].items():
+            for part in component['parts']:
+                name = part['name']
+                if name not in glyphs:
+                    continue
+                for k in ('startConnector', 'endConnector'):
+                    count = len(font.master_user_data(k).get(name, ()))
+                    if count != len(master_ids):
+                        issues.append(_issue(
+                            'master-data', name,
+                            f'"{k}" of the {key} part of "{glyph}" is in {count} of the '
+                            f'{len(master_ids)} master layers.'
+                        ))
+    return issues
+
+
+def _validate_font(task: tuple) -> list[dict[str, str]]:
+    return validate_font(*task)
+
+
+def validate(
+    font_paths: list[str],
+    input_path: str,
+    toml_path: str = 'src/FiraMath.toml',
+    check_source: bool = True,
+    parallel: bool = True,
+    processes: int = None,
+) -> dict[str, list[dict[str, str]]]:
+    '''Validate the fonts `font_paths` built from the Glyphs source `input_path`, and the
+    source if `check_source`. The fonts are checked in a pool of `processes` processes if
+    `parallel`. Return the issues of each file, keyed by its path.
+    '''
+    # The source gives the production names of the fonts, so it's loaded even if not checked.
+    font = Font(input_path, processes=None if parallel else 1)
+    results = {}
+    if check_source:
+        results[input_path] = validate_source(font, toml_path)
+    tasks = [(path, toml_path, font.production_names) for path in font_paths]
+    for path, (issues, error) in zip(
+        font_paths, map_with_errors(_validate_font, tasks, parallel, processes)
+    ):
+        results[path] = [_issue('error', None, error)] if error else issues
+    return results
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description='Check the MATH tables of Fira Math.')
+    parser.add_argument(
+        'fonts', nargs='*', help='OTF files to check (default: the OTF files in build/)'
+    )
+    parser.add_argument(
+        '--input', default='src/FiraMath.glyphspackage', help='Glyphs source of the fonts'
+    )
+    parser.add_argument('--toml', default='src/FiraMath.toml', help='MATH table data')
+    parser.add_argument('--no-source', action='store_true', help="don't check the source")
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+    parser.add_argument('-o', '--output', help='write the issues as JSON to this file')
+    args = parser.parse_args(argv)
+    font_paths = args.fonts or sorted(glob.glob(os.path.join('build', '*.otf')))
+    results = validate(
+        font_paths,
+        args.input,
+        args.toml,
+        check_source=not args.no_source,
+        parallel=args.jobs != 1,
+        processes=args.jobs,
+    )
+    for path, issues in results.items():
+        eprint(f'=> {os.path.basename(path)}: {len(issues)} issues')
+        for issue in issues:
+            eprint(f'   [{issue["check"]}] {issue["glyph"] or ""}: {issue["message"]}')
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    if any(results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
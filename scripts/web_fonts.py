@@ -0,0 +1,242 @@
+'''WOFF2 fonts and Unicode-range subsets for the web.
+
+Each OTF gets a full WOFF2 font, and WOFF2 subsets for the ranges in `UNICODE_RANGES` with a CSS
+file of `@font-face` rules, so that browsers only download the subsets used by a page. The
+subsets are closed over GSUB (including `ssty`) and the MATH variants and assemblies, so the
+glyphs reachable from their characters are all kept.
+'''
+
+import os
+
+from fontTools import subset
+from fontTools.ttLib import TTFont, woff2
+
+from build_cache import BuildCache
+from math_table import MathGlyphClosure
+
+# Subset name -> (first, last) code point ranges. The code points of the font outside all these
+# ranges go into an extra `other` subset.
+UNICODE_RANGES: dict[str, list[tuple[int, int]]] = {
+    'latin': [
+        (0x0000, 0x024F),  # Basic Latin to Latin Extended-B
+        (0x1E00, 0x1EFF),  # Latin Extended Additional
+        (0x2000, 0x206F),  # General Punctuation
+        (0x20A0, 0x20CF),  # Currency Symbols
+        (0x2100, 0x214F),  # Letterlike Symbols
+        (0x1D400, 0x1D6A7),  # Mathematical Alphanumeric Symbols: Latin
+        (0x1D7CE, 0x1D7FF),  # Mathematical Alphanumeric Symbols: digits
+    ],
+    'greek': [
+        (0x0370, 0x03FF),  # Greek and Coptic
+        (0x1D6A8, 0x1D7CD),  # Mathematical Alphanumeric Symbols: Greek
+    ],
+    'arrows': [
+        (0x2190, 0x21FF),  # Arrows
+        (0x27F0, 0x27FF),  # Supplemental Arrows-A
+        (0x2900, 0x297F),  # Supplemental Arrows-B
+        (0x2B00, 0x2BFF),  # Miscellaneous Symbols and Arrows
+    ],
+    'operators': [
+        (0x2200, 0x22FF),  # Mathematical Operators
+        (0x2300, 0x23FF),  # Miscellaneous Technical
+        (0x27C0, 0x27EF),  # Miscellaneous Mathematical Symbols-A
+        (0x2980, 0x29FF),  # Miscellaneous Mathematical Symbols-B
+        (0x2A00, 0x2AFF),  # Supplemental Mathematical Operators
+    ],
+}
+
+# Change this when the subsetting options change, to invalidate the cached subsets.
+_SUBSET_VERSION = 1
+
+
+class Subsetter:
+    '''Make subsets of fonts for sets of code points.
+
+    The subsets are stored in the build cache under the hash of the font, the code points and
+    the flavor, so asking for the same subset again only copies the cached file. The glyphs of a
+    subset can be known without making it with `glyphs()`, e.g. to decide which subsets a page
+    needs.
+    '''
+
+    def __init__(self, cache: BuildCache):
+        self.cache = cache
+        # (path, size, mtime) -> hash of the font file
+        self._font_hashes: dict[tuple, str] = {}
+        # Hash of the font file -> its closure
+        self._closures: dict[str, MathGlyphClosure] = {}
+
+    def closure(self, font_path: str) -> MathGlyphClosure:
+        '''Return the `MathGlyphClosure` of the font `font_path`, built once per font from its
+        cmap, the variants and assemblies of its MATH table and its GSUB substitutions.
+        '''
+        font_hash = self._font_hash(font_path)
+        if font_hash not in self._closures:
+            with TTFont(font_path, lazy=True) as tt_font:
+                self._closures[font_hash] = _math_glyph_closure(tt_font)
+        return self._closures[font_hash]
+
+    def glyphs(self, font_path: str, codepoints: set[int]) -> set[str]:
+        '''Return the glyphs that the subset of the font `font_path` for `codepoints` keeps
+        through the cmap, MATH and GSUB, without making the subset.
+        '''
+        return self.closure(font_path).glyphs(codepoints)
+
+    def subset(
+        self,
+        font_path: str,
+        codepoints: set[int],
+        output_path: str,
+        flavor: str = 'woff2',
+    ) -> str:
+        '''Write the subset of the font `font_path` for `codepoints` to `output_path`, as a WOFF2
+        font by default (or `flavor` 'woff', or `None` for an OpenType font). Return
+        `output_path`.
+        '''
+        key = BuildCache.hash_values(
+            'subset', _SUBSET_VERSION, self._font_hash(font_path), sorted(codepoints), flavor
+        )
+        if not self.cache.get('subset', key, output_path):
+            # Keep the timestamps of the font, so that the subsets are reproducible.
+            with TTFont(font_path, recalcTimestamp=False) as tt_font:
+                subsetter = subset.Subsetter(_subset_options())
+                subsetter.populate(unicodes=codepoints)
+                subsetter.subset(tt_font)
+                tt_font.flavor = flavor
+                tt_font.save(output_path, reorderTables=False)
+            self.cache.put('subset', key, output_path)
+        return output_path
+
+    def compress(self, font_path: str, output_path: str) -> str:
+        '''Write the whole font `font_path` as a WOFF2 font to `output_path`, and return
+        `output_path`.
+        '''
+        key = BuildCache.hash_values('woff2', self._font_hash(font_path))
+        if not self.cache.get('woff2', key, output_path):
+            woff2.compress(font_path, output_path)
+            self.cache.put('woff2', key, output_path)
+        return output_path
+
+    def _font_hash(self, font_path: str) -> str:
+        stat = os.stat(font_path)
+        file_key = (os.path.abspath(font_path), stat.st_size, stat.st_mtime_ns)
+        if file_key not in self._font_hashes:
+            self._font_hashes[file_key] = BuildCache.hash_file(font_path)
+        return self._font_hashes[file_key]
+
+
+def build_web_fonts(
+    font_path: str,
+    output_dir: str,
+    subsetter: Subsetter,
+    family_name: str,
+) -> list[str]:
+    '''Write the WOFF2 font, the subsets and the CSS file of the OTF `font_path` to `output_dir`,
+    and return their paths.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(font_path))[0]
+    with TTFont(font_path, lazy=True) as tt_font:
+        font_codepoints = set(tt_font.getBestCmap())
+        weight = tt_font['OS/2'].usWeightClass
+    paths = [subsetter.compress(font_path, os.path.join(output_dir, f'{name}.woff2'))]
+    font_faces = []
+    for subset_name, codepoints in _split_codepoints(font_codepoints).items():
+        file_name = f'{name}-{subset_name}.woff2'
+        paths.append(subsetter.subset(font_path, codepoints, os.path.join(output_dir, file_name)))
+        font_faces.append(_font_face(family_name, weight, file_name, codepoints))
+    css_path = os.path.join(output_dir, f'{name}.css')
+    with open(css_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(font_faces))
+    paths.append(css_path)
+    return paths
+
+
+def _math_glyph_closure(tt_font: TTFont) -> MathGlyphClosure:
+    variants = {
+        key: {} for key in (
+            'HorizontalVariants', 'VerticalVariants', 'HorizontalComponents', 'VerticalComponents'
+        )
+    }
+    math_variants = tt_font['MATH'].table.MathVariants if 'MATH' in tt_font else None
+    for direction, prefix in (('Horizontal', 'Horiz'), ('Vertical', 'Vert')):
+        coverage = getattr(math_variants, f'{prefix}GlyphCoverage', None)
+        if coverage is None:
+            continue
+        for glyph, construction in zip(
+            coverage.glyphs, getattr(math_variants, f'{prefix}GlyphConstruction')
+        ):
+            variants[f'{direction}Variants'][glyph] = [
+                r.VariantGlyph for r in construction.MathGlyphVariantRecord
+            ]
+            if construction.GlyphAssembly:
+                variants[f'{direction}Components'][glyph] = {
+                    'parts': [{'name': p.glyph} for p in construction.GlyphAssembly.PartRecords]
+                }
+    return MathGlyphClosure(variants, tt_font.getBestCmap(), _gsub_alternates(tt_font))
+
+
+def _gsub_alternates(tt_font: TTFont) -> dict[str, list[str]]:
+    '''Return the glyphs substituted for each glyph by the single, multiple and alternate
+    substitutions of GSUB (e.g. `ssty`).
+    '''
+    result = {}
+    if 'GSUB' not in tt_font or not tt_font['GSUB'].table.LookupList:
+        return result
+    for lookup in tt_font['GSUB'].table.LookupList.Lookup:
+        for subtable in lookup.SubTable:
+            if subtable.LookupType == 7:
+                subtable = subtable.ExtSubTable
+            if subtable.LookupType == 1:
+                substitutions = {g: [s] for g, s in subtable.mapping.items()}
+            elif subtable.LookupType == 2:
+                substitutions = subtable.mapping
+            elif subtable.LookupType == 3:
+                substitutions = subtable.alternates
+            else:
+                continue
+            for glyph, alternates in substitutions.items():
+                result.setdefault(glyph, []).extend(alternates)
+    return result
+
+
+def _split_codepoints(codepoints: set[int]) -> dict[str, set[int]]:
+    '''Split `codepoints` by `UNICODE_RANGES`, leaving out the empty subsets.'''
+    result = {}
+    for name, ranges in UNICODE_RANGES.items():
+        result[name] = {c for c in codepoints if any(a <= c <= b for a, b in ranges)}
+    result['other'] = codepoints.difference(*result.values())
+    return {name: value for name, value in result.items() if value}
+
+
+def _font_face(family_name: str, weight: int, file_name: str, codepoints: set[int]) -> str:
+    return (
+        '@font-face {\n'
+        f'  font-family: "{family_name}";\n'
+        f'  font-weight: {weight};\n'
+        f'  src: url("{file_name}") format("woff2");\n'
+        f'  unicode-range: {", ".join(_unicode_ranges(codepoints))};\n'
+        '}\n'
+    )
+
+
+def _unicode_ranges(codepoints: set[int]) -> list[str]:
+    '''Return the CSS `unicode-range` values of `codepoints`, merging consecutive code points.'''
+    ranges = []
+    for c in sorted(codepoints):
+        if ranges and ranges[-1][1] == c - 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return [f'U+{a:X}' if a == b else f'U+{a:X}-{b:X}' for a, b in ranges]
+
+
+def _subset_options() -> subset.Options:
+    options = subset.Options()
+    # Keep all the features, e.g. `ssty` for the script styles of math
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    options.name_languages = ['*']
+    options.name_legacy = True
+    options.notdef_outline = True
+    options.glyph_names = True
+    return options